@@ -0,0 +1,264 @@
+# Benchmarks parsing, rendering and end-to-end queries on the meal plans in
+# benchmarks/fixtures, which are served by a local stand-in for the API, so
+# no network access is needed.
+# Exits with status 1 if a result exceeds its threshold in --thresholds, or
+# if a plan parsed in chunks differs from the plan parsed at once.
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs
+import xml.etree.ElementTree as ET
+
+from bonn_mensa.client import HttpClient
+from bonn_mensa.filters import MealFilter
+from bonn_mensa.mensa import (
+    SimpleMensaResponseParser,
+    canteen_id_dict,
+    category_to_dict,
+    language_id_dict,
+    meal_plan_to_xml,
+    query_mensa,
+)
+from bonn_mensa.render import get_renderer
+from bonn_mensa.snapshot import plan_from_snapshot, plan_to_snapshot
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DEFAULT_THRESHOLDS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "thresholds.json"
+)
+
+# (canteen, language) -> html
+Fixtures = Dict[Tuple[str, str], str]
+
+
+def load_fixtures() -> Fixtures:
+    fixtures = {}
+    for filename in sorted(os.listdir(FIXTURES_DIR)):
+        name, ext = os.path.splitext(filename)
+        if ext != ".html":
+            continue
+        canteen, language = name.rsplit("_", 1)
+        with open(os.path.join(FIXTURES_DIR, filename), encoding="utf-8") as f:
+            fixtures[(canteen, language)] = f.read()
+    return fixtures
+
+
+class FixtureServer:
+    # answers the meals AJAX POST like the real API, from the fixtures
+    def __init__(self, fixtures: Fixtures, latency: float = 0.0) -> None:
+        canteens = {id: name for name, id in canteen_id_dict.items()}
+        languages = {id: name for name, id in language_id_dict.items()}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                fields = parse_qs(self.rfile.read(length).decode("utf-8"))
+                key = (
+                    canteens.get(fields["tx_festwb_mealsajax[canteen]"][0]),
+                    languages.get(fields["tx_festwb_mealsajax[language]"][0]),
+                )
+                body = fixtures.get(key, "").encode("utf-8")
+                time.sleep(latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def __enter__(self) -> "FixtureServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def parse(html: str, language: str):
+    parser = SimpleMensaResponseParser(lang=language)
+    parser.feed(html)
+    parser.close()
+    return parser.categories
+
+
+def check_chunked_parsing(fixtures: Fixtures) -> List[str]:
+    # responses are parsed while they are downloaded, so parsing them in
+    # chunks of any size has to give the same plan as parsing them at once
+    def parse_chunks(html: str, language: str, size: int) -> Tuple:
+        parser = SimpleMensaResponseParser(lang=language)
+        for start in range(0, len(html), size):
+            parser.feed(html[start : start + size])
+        parser.close()
+        categories = [category_to_dict(cat) for cat in parser.categories]
+        return categories, parser.info, [str(error) for error in parser.errors]
+
+    mismatches = []
+    for (canteen, language), html in fixtures.items():
+        expected = parse_chunks(html, language, len(html) or 1)
+        for size in (1, 13, 97, 4096):
+            if parse_chunks(html, language, size) != expected:
+                mismatches.append(f"{canteen}_{language} in chunks of {size}")
+    return mismatches
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    # median seconds per call
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run_benchmarks(fixtures: Fixtures, repeat: int, latency: float) -> Dict[str, float]:
+    results: Dict[str, float] = {}
+    parsed = {key: parse(html, key[1]) for key, html in fixtures.items()}
+    total_kb = sum(len(html.encode("utf-8")) for html in fixtures.values()) / 1024
+
+    parse_time = measure(
+        lambda: [parse(html, key[1]) for key, html in fixtures.items()], repeat
+    )
+    results["parse_ms_per_kb"] = 1000 * parse_time / total_kb
+
+    # loading the parsed plans from their snapshots instead of the HTML
+    snapshots = [json.dumps(plan_to_snapshot(plan)) for plan in parsed.values()]
+    results["snapshot_load_ms"] = 1000 * measure(
+        lambda: [plan_from_snapshot(json.loads(snapshot)) for snapshot in snapshots],
+        repeat,
+    )
+
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    kept = [parse(html, key[1]) for key, html in fixtures.items()]
+    snapshot_after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = snapshot_after.compare_to(snapshot_before, "filename")
+    results["parse_allocated_blocks"] = sum(stat.count_diff for stat in stats)
+    results["parse_peak_kb"] = peak / 1024
+    del kept
+
+    def render(markdown_output: bool) -> None:
+        for (canteen, language), categories in parsed.items():
+            renderer = get_renderer(
+                language,
+                markdown_output=markdown_output,
+                show_all_allergens=True,
+                show_additives=True,
+                show_co2=True,
+            )
+            renderer.render(categories, date="2024-11-04", canteen=canteen)
+            renderer.getvalue()
+
+    results["render_terminal_ms"] = 1000 * measure(lambda: render(False), repeat)
+    results["render_markdown_ms"] = 1000 * measure(lambda: render(True), repeat)
+    meal_filter = MealFilter.from_rules(
+        ["allergen!=40,46", "price<=4.50", "co2=green,orange", "title!~pommes"],
+        filter_mode="vegetarian",
+    )
+    results["filter_ms"] = 1000 * measure(
+        lambda: [meal_filter.filter_plan(categories) for categories in parsed.values()],
+        repeat,
+    )
+    results["render_xml_ms"] = 1000 * measure(
+        lambda: [
+            ET.tostring(meal_plan_to_xml(categories, canteen), encoding="utf-8")
+            for (canteen, _), categories in parsed.items()
+        ],
+        repeat,
+    )
+
+    with FixtureServer(fixtures, latency=latency) as server:
+        client = HttpClient()
+
+        def query() -> None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                query_mensa(
+                    date="2024-11-04",
+                    canteen="CAMPO",
+                    filtered_categories=[],
+                    language="de",
+                    url=server.url,
+                    colors=False,
+                    client=client,
+                )
+
+        results["end_to_end_ms"] = 1000 * measure(query, repeat)
+        client.close()
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser("bench")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="Number of runs per benchmark. Defaults to 50.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the stand-in API waits before answering. Defaults to 0.",
+    )
+    parser.add_argument(
+        "--thresholds",
+        type=str,
+        default=DEFAULT_THRESHOLDS,
+        help="JSON file with the maximum allowed value per benchmark.",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the results as JSON.",
+    )
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    mismatches = check_chunked_parsing(fixtures)
+    for mismatch in mismatches:
+        print(f"Parsing {mismatch} differs from parsing at once", file=sys.stderr)
+
+    results = run_benchmarks(fixtures, repeat=args.repeat, latency=args.latency)
+
+    thresholds: Dict[str, float] = {}
+    if args.thresholds:
+        with open(args.thresholds, encoding="utf-8") as f:
+            thresholds = json.load(f)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    failed = bool(mismatches)
+    for name, value in results.items():
+        threshold = thresholds.get(name)
+        exceeded = threshold is not None and value > threshold
+        failed |= exceeded
+        if not args.json:
+            limit = f" (threshold {threshold:g})" if threshold is not None else ""
+            marker = " EXCEEDED" if exceeded else ""
+            print(f"{name:<24} {value:>10.3f}{limit}{marker}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
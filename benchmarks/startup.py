@@ -0,0 +1,103 @@
+# Checks the startup time of the mensa CLI against a budget.
+# Exits with status 1 if importing bonn_mensa.mensa pulls in one of the heavy
+# dependencies or if a budget is exceeded.
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+# only needed once a plan is fetched, parsed into xml or dated
+HEAVY_MODULES = [
+    "holidays",
+    "requests",
+    "urllib3",
+    "xml.etree.ElementTree",
+    "argcomplete",
+    "concurrent.futures",
+]
+
+
+def import_times(module: str) -> Dict[str, int]:
+    # cumulative import time in microseconds per imported module
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def wall_times(args: List[str], runs: int) -> List[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser("startup")
+    parser.add_argument(
+        "--import-budget-ms",
+        type=float,
+        default=60.0,
+        help="Budget for importing bonn_mensa.mensa. Defaults to 60ms.",
+    )
+    parser.add_argument(
+        "--version-budget-ms",
+        type=float,
+        default=250.0,
+        help="Budget for the median run of `mensa --version`. Defaults to 250ms.",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="Number of runs of `mensa --version`. Defaults to 10.",
+    )
+    args = parser.parse_args()
+
+    failed = False
+
+    times = import_times("bonn_mensa.mensa")
+    import_ms = times["bonn_mensa.mensa"] / 1000
+    print(f"import bonn_mensa.mensa: {import_ms:.1f}ms")
+    if import_ms > args.import_budget_ms:
+        print(f"  exceeds the budget of {args.import_budget_ms:.1f}ms")
+        failed = True
+
+    for module in HEAVY_MODULES:
+        if module in times:
+            print(f"  imports {module} ({times[module] / 1000:.1f}ms)")
+            failed = True
+
+    version_ms = 1000 * statistics.median(
+        wall_times([sys.executable, "-m", "bonn_mensa.mensa", "--version"], args.runs)
+    )
+    baseline_ms = 1000 * statistics.median(
+        wall_times([sys.executable, "-c", "pass"], args.runs)
+    )
+    print(
+        f"mensa --version: {version_ms:.1f}ms "
+        f"(interpreter startup {baseline_ms:.1f}ms)"
+    )
+    if version_ms > args.version_budget_ms:
+        print(f"  exceeds the budget of {args.version_budget_ms:.1f}ms")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Set, Tuple
+
+from bonn_mensa.mensa import PRICE_ATTRS, Category, Meal, PlanKey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meals (
+    id INTEGER PRIMARY KEY,
+    canteen TEXT NOT NULL,
+    date TEXT NOT NULL,
+    language TEXT NOT NULL,
+    category TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL COLLATE NOCASE,
+    student_price INTEGER,
+    staff_price INTEGER,
+    guest_price INTEGER,
+    co2_emission INTEGER,
+    co2_tag TEXT
+);
+CREATE INDEX IF NOT EXISTS meals_canteen_date ON meals (canteen, date, language);
+CREATE INDEX IF NOT EXISTS meals_title ON meals (title);
+CREATE INDEX IF NOT EXISTS meals_date ON meals (date);
+
+CREATE TABLE IF NOT EXISTS meal_allergens (
+    meal_id INTEGER NOT NULL REFERENCES meals (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    allergen TEXT NOT NULL,
+    PRIMARY KEY (meal_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS meal_allergens_allergen ON meal_allergens (allergen);
+
+CREATE TABLE IF NOT EXISTS plans (
+    canteen TEXT NOT NULL,
+    date TEXT NOT NULL,
+    language TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (canteen, date, language)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meal_additives (
+    meal_id INTEGER NOT NULL REFERENCES meals (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    additive TEXT NOT NULL,
+    PRIMARY KEY (meal_id, position)
+) WITHOUT ROWID;
+"""
+
+# (date, canteen, category, meal)
+ArchivedMeal = Tuple[str, str, str, Meal]
+
+
+def default_archive_path() -> str:
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "share"
+    )
+    return os.path.join(data_home, "bonn-mensa", "archive.sqlite3")
+
+
+class MealArchive:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or default_archive_path()
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def store(
+        self, canteen: str, date: str, language: str, categories: List[Category]
+    ) -> None:
+        self.store_many([((canteen, date, language), categories)])
+
+    def store_many(self, plans: Iterable[Tuple[PlanKey, List[Category]]]) -> None:
+        # all plans are stored in one transaction, which is much faster than
+        # one per plan when filling the archive
+        with self._lock, self._connection as connection:
+            stored_at = time.time()
+            for (canteen, date, language), categories in plans:
+                self._insert_plan(
+                    connection, canteen, date, language, categories, stored_at
+                )
+
+    @staticmethod
+    def _insert_plan(
+        connection: sqlite3.Connection,
+        canteen: str,
+        date: str,
+        language: str,
+        categories: List[Category],
+        stored_at: float,
+    ) -> None:
+        # a plan is replaced as a whole, meals removed from it upstream must
+        # not survive in the archive
+        connection.execute(
+            "DELETE FROM meals WHERE canteen = ? AND date = ? AND language = ?",
+            (canteen, date, language),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?)",
+            (canteen, date, language, stored_at),
+        )
+        position = 0
+        for cat in categories:
+            for meal in cat.meals:
+                cursor = connection.execute(
+                    """INSERT INTO meals (
+                        canteen, date, language, category, position, title,
+                        student_price, staff_price, guest_price,
+                        co2_emission, co2_tag
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (
+                        canteen,
+                        date,
+                        language,
+                        cat.title,
+                        position,
+                        meal.title,
+                        meal.student_price,
+                        meal.staff_price,
+                        meal.guest_price,
+                        meal.co2_emission,
+                        meal.co2_tag,
+                    ),
+                )
+                position += 1
+                meal_id = cursor.lastrowid
+                connection.executemany(
+                    "INSERT INTO meal_allergens VALUES (?, ?, ?)",
+                    [(meal_id, idx, al) for idx, al in enumerate(meal.allergens)],
+                )
+                connection.executemany(
+                    "INSERT INTO meal_additives VALUES (?, ?, ?)",
+                    [(meal_id, idx, ad) for idx, ad in enumerate(meal.additives)],
+                )
+
+    def archived_plans(self, since: str, until: str) -> Set[PlanKey]:
+        # plans archived before the plans table existed only have meals
+        with self._lock:
+            rows = self._connection.execute(
+                """SELECT canteen, date, language FROM plans WHERE date BETWEEN ? AND ?
+                UNION SELECT canteen, date, language FROM meals WHERE date BETWEEN ? AND ?""",
+                (since, until, since, until),
+            ).fetchall()
+        return set(rows)
+
+    def stored_at(self, canteen: str, date: str, language: str) -> Optional[float]:
+        # plans archived before the time was recorded have none
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT stored_at FROM plans WHERE canteen = ? AND date = ? AND language = ?",
+                (canteen, date, language),
+            ).fetchone()
+        return row[0] if row else None
+
+    def load_plan(self, canteen: str, date: str, language: str) -> List[Category]:
+        rows = self._select_meals(
+            "canteen = ? AND date = ? AND language = ?",
+            (canteen, date, language),
+            order_by="position",
+        )
+        categories: List[Category] = []
+        for _, _, category, meal in rows:
+            if not categories or categories[-1].title != category:
+                categories.append(Category(category))
+            categories[-1].add_meal(meal)
+        return categories
+
+    def last_served(
+        self,
+        title: str,
+        canteen: Optional[str] = None,
+        language: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = 1,
+    ) -> List[ArchivedMeal]:
+        where = "title LIKE ?"
+        params: list = [f"%{title}%"]
+        if until:
+            where += " AND date <= ?"
+            params.append(until)
+        if canteen:
+            where += " AND canteen = ?"
+            params.append(canteen)
+        if language:
+            where += " AND language = ?"
+            params.append(language)
+        return self._select_meals(
+            where, params, order_by="date DESC, canteen", limit=limit
+        )
+
+    def cheapest(
+        self,
+        since: str,
+        until: Optional[str] = None,
+        canteen: Optional[str] = None,
+        language: Optional[str] = None,
+        exclude_allergens: Iterable[str] = (),
+        price: str = "Student",
+        limit: int = 1,
+    ) -> List[ArchivedMeal]:
+        # the price columns are named like the Meal attributes
+        price_column = PRICE_ATTRS[price]
+        where = f"date >= ? AND {price_column} IS NOT NULL"
+        params: list = [since]
+        if until:
+            where += " AND date <= ?"
+            params.append(until)
+        if canteen:
+            where += " AND canteen = ?"
+            params.append(canteen)
+        if language:
+            where += " AND language = ?"
+            params.append(language)
+        exclude_allergens = list(exclude_allergens)
+        if exclude_allergens:
+            placeholders = ", ".join("?" for _ in exclude_allergens)
+            where += f""" AND NOT EXISTS (
+                SELECT 1 FROM meal_allergens
+                WHERE meal_id = meals.id AND allergen IN ({placeholders})
+            )"""
+            params.extend(exclude_allergens)
+        return self._select_meals(
+            where, params, order_by=f"{price_column}, date DESC", limit=limit
+        )
+
+    def _select_meals(
+        self,
+        where: str,
+        params: Iterable,
+        order_by: str,
+        limit: Optional[int] = None,
+    ) -> List[ArchivedMeal]:
+        query = f"""SELECT id, date, canteen, category, title, student_price,
+            staff_price, guest_price, co2_emission, co2_tag
+            FROM meals WHERE {where} ORDER BY {order_by}"""
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+
+        with self._lock:
+            rows = self._connection.execute(query, list(params)).fetchall()
+            meals = {}
+            results: List[ArchivedMeal] = []
+            for row in rows:
+                meal = Meal(row[4])
+                (
+                    meal.student_price,
+                    meal.staff_price,
+                    meal.guest_price,
+                    meal.co2_emission,
+                    meal.co2_tag,
+                ) = row[5:]
+                meals[row[0]] = meal
+                results.append((row[1], row[2], row[3], meal))
+
+            if meals:
+                placeholders = ", ".join("?" for _ in meals)
+                for table, column, add in (
+                    ("meal_allergens", "allergen", Meal.add_allergen),
+                    ("meal_additives", "additive", Meal.add_additive),
+                ):
+                    for meal_id, value in self._connection.execute(
+                        f"""SELECT meal_id, {column} FROM {table}
+                        WHERE meal_id IN ({placeholders}) ORDER BY meal_id, position""",
+                        list(meals),
+                    ):
+                        add(meals[meal_id], value)
+
+        return results
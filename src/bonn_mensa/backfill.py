@@ -0,0 +1,285 @@
+import argparse
+import datetime
+import sys
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from bonn_mensa.archive import MealArchive
+from bonn_mensa.client import (
+    DEFAULT_POOL_SIZE,
+    HttpClient,
+    RateLimiter,
+    get_client,
+    set_client,
+)
+from bonn_mensa.mensa import (
+    MEALS_URL,
+    Category,
+    PlanKey,
+    SimpleMensaResponseParser,
+    canteen_id_dict,
+    fetch_meal_plan_html,
+    is_open_day,
+    iso_date,
+    language_id_dict,
+    non_negative_int,
+    positive_int,
+)
+from bonn_mensa.snapshot import plan_from_snapshot, plan_to_snapshot
+
+DEFAULT_RATE = 2.0
+DEFAULT_BATCH_SIZE = 50
+
+
+def backfill_keys(
+    since: datetime.date,
+    until: datetime.date,
+    canteens: Sequence[str],
+    languages: Sequence[str],
+) -> List[PlanKey]:
+    keys = []
+    day = since
+    while day <= until:
+        if is_open_day(day):
+            keys.extend(
+                (canteen, day.isoformat(), language)
+                for canteen in canteens
+                for language in languages
+            )
+        day += datetime.timedelta(days=1)
+    return keys
+
+
+def parse_plan(html: str, language: str) -> Tuple[Dict, List[str]]:
+    # runs in a worker process. The plan is handed back as a snapshot, since
+    # the allergen bits of the worker mean nothing in the parent process.
+    parser = SimpleMensaResponseParser(lang=language)
+    parser.feed(html)
+    parser.close()
+    return plan_to_snapshot(parser.categories, parser.info), [
+        str(error) for error in parser.errors
+    ]
+
+
+class BackfillResult:
+    def __init__(self) -> None:
+        self.stored = 0
+        self.failed: List[PlanKey] = []
+
+
+def backfill(
+    keys: Sequence[PlanKey],
+    archive: MealArchive,
+    max_workers: int = 4,
+    processes: Optional[int] = None,
+    rate: float = DEFAULT_RATE,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    url: str = MEALS_URL,
+    client: Optional[HttpClient] = None,
+    verbose: bool = False,
+) -> BackfillResult:
+    # downloads run in threads, spaced out by the rate limit, and parsing in
+    # a process pool, so it is spread over all cores. The plans are archived
+    # in batches, and every batch is committed, so an interrupted backfill
+    # only loses the plans of the current batch.
+    from concurrent.futures import (
+        FIRST_COMPLETED,
+        Future,
+        ProcessPoolExecutor,
+        ThreadPoolExecutor,
+        wait,
+    )
+
+    client = client or get_client()
+    limiter = RateLimiter(rate)
+    today = datetime.date.today().isoformat()
+    result = BackfillResult()
+    batch: List[Tuple[PlanKey, List[Category]]] = []
+
+    def download(key: PlanKey) -> str:
+        limiter.wait()
+        canteen, date, language = key
+        return fetch_meal_plan_html(date, canteen, language, url=url, client=client)
+
+    def store_batch() -> None:
+        archive.store_many(batch)
+        result.stored += len(batch)
+        batch.clear()
+        print(f"Archived {result.stored} of {len(keys)} plans")
+
+    fetchers = ThreadPoolExecutor(max_workers=max_workers)
+    # processes=0 parses in this process, e.g. for debugging. The workers
+    # are spawned, since forking while the download threads run is unsafe.
+    parsers = None
+    if processes != 0:
+        import multiprocessing
+
+        parsers = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        )
+    # future -> (key, whether it is a download or a parse)
+    pending: Dict[Future, Tuple[PlanKey, bool]] = {
+        fetchers.submit(download, key): (key, True) for key in keys
+    }
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, is_download = pending.pop(future)
+                canteen, date, language = key
+                try:
+                    value = future.result()
+                except Exception as e:
+                    print(f"Backfilling {canteen} for {date} [{language}] failed: {e}")
+                    result.failed.append(key)
+                    continue
+
+                if is_download and parsers is not None:
+                    pending[parsers.submit(parse_plan, value, language)] = (key, False)
+                    continue
+                snapshot, errors = parse_plan(value, language) if is_download else value
+                for error in errors:
+                    print(f"Could not parse {canteen} on {date}: {error}")
+                categories = plan_from_snapshot(snapshot)
+                # an empty plan of a past day means the canteen was closed, so
+                # it is archived as such and not asked for again
+                if categories or date < today:
+                    batch.append((key, categories))
+                if verbose:
+                    print(f"Fetched {canteen} for {date} [{language}]")
+                if len(batch) >= batch_size:
+                    store_batch()
+    finally:
+        if batch:
+            store_batch()
+        fetchers.shutdown(wait=False, cancel_futures=True)
+        if parsers is not None:
+            parsers.shutdown(cancel_futures=True)
+    return result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("mensa backfill")
+    parser.add_argument(
+        "--from",
+        dest="since",
+        type=iso_date,
+        required=True,
+        metavar="DATE",
+        help="The first day to archive in YYYY-MM-DD format.",
+    )
+    parser.add_argument(
+        "--to",
+        dest="until",
+        type=iso_date,
+        default=None,
+        metavar="DATE",
+        help="The last day to archive in YYYY-MM-DD format. Defaults to today.",
+    )
+    parser.add_argument(
+        "--mensa",
+        nargs="+",
+        choices=[*canteen_id_dict.keys(), "all"],
+        default=["all"],
+        help="The canteens to archive. Defaults to all.",
+    )
+    parser.add_argument(
+        "--lang",
+        nargs="+",
+        choices=list(language_id_dict),
+        default=list(language_id_dict),
+        help="The languages to archive. Defaults to all.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=4,
+        help="The maximum number of concurrent requests. Defaults to 4.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DEFAULT_RATE,
+        help=f"The maximum number of requests per second, 0 for no limit. Defaults to {DEFAULT_RATE:g}.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=non_negative_int,
+        default=None,
+        help="The number of processes parsing the plans, 0 parses in the main process. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"The number of plans archived per transaction. Defaults to {DEFAULT_BATCH_SIZE}.",
+    )
+    parser.add_argument(
+        "--archive-path",
+        type=str,
+        default=None,
+        help="The SQLite database of the archive. Defaults to $XDG_DATA_HOME/bonn-mensa/archive.sqlite3.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for the API to respond. Defaults to 30.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print every fetched plan.",
+    )
+    return parser
+
+
+def run_cmd(args):
+    until = args.until or datetime.date.today()
+    canteens = list(canteen_id_dict) if "all" in args.mensa else args.mensa
+    archive = MealArchive(args.archive_path)
+
+    # plans that are archived already are skipped, which also resumes an
+    # interrupted backfill
+    archived = archive.archived_plans(args.since.isoformat(), until.isoformat())
+    keys = [
+        key
+        for key in backfill_keys(args.since, until, canteens, args.lang)
+        if key not in archived
+    ]
+    print(f"{len(keys)} plans to fetch, {len(archived)} already archived")
+    if not keys:
+        return 0
+
+    set_client(
+        HttpClient(
+            timeout=(min(5.0, args.timeout), args.timeout),
+            pool_size=max(args.jobs, DEFAULT_POOL_SIZE),
+        )
+    )
+    start = time.perf_counter()
+    try:
+        result = backfill(
+            keys,
+            archive,
+            max_workers=args.jobs,
+            processes=args.processes,
+            rate=args.rate,
+            batch_size=args.batch_size,
+            verbose=args.verbose,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to continue", file=sys.stderr)
+        return 130
+    finally:
+        archive.close()
+
+    seconds = time.perf_counter() - start
+    print(f"Archived {result.stored} plans in {seconds:.1f}s")
+    if result.failed:
+        print(
+            f"{len(result.failed)} plans failed, run the same command again to retry",
+            file=sys.stderr,
+        )
+        return 1
+    return 0
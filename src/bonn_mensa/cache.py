@@ -0,0 +1,192 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Mapping, Optional
+
+DEFAULT_TTL = 30 * 60
+# plans of past days are not changed anymore
+DEFAULT_PAST_TTL = 365 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+# a full cache is shrunk to this share of its maximum size, so it is not
+# scanned again on the next write
+EVICT_TARGET = 0.9
+
+
+def default_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "bonn-mensa")
+
+
+class CacheEntry:
+    def __init__(
+        self,
+        text: str,
+        fetched_at: float,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        fresh_until: Optional[float] = None,
+        plan: Optional[Dict] = None,
+    ) -> None:
+        self.text = text
+        self.fetched_at = fetched_at
+        self.etag = etag
+        self.last_modified = last_modified
+        # prefetched entries are used without asking the API until this time,
+        # whatever the ttl of the reader is
+        self.fresh_until = fresh_until
+        # the snapshot of the parsed plan, so it is not parsed again
+        self.plan = plan
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def is_fresh(self, ttl: float) -> bool:
+        if self.fresh_until is not None and time.time() < self.fresh_until:
+            return True
+        return self.age < ttl
+
+    def revalidation_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        ttl: float = DEFAULT_TTL,
+        past_ttl: float = DEFAULT_PAST_TTL,
+        max_size: int = DEFAULT_MAX_SIZE,
+    ) -> None:
+        self.directory = directory or default_cache_dir()
+        self.ttl = ttl
+        self.past_ttl = past_ttl
+        self.max_size = max_size
+        # the approximate size of the cache, known after the first eviction.
+        # It is updated on every write, so the directory is only scanned again
+        # once it is too large, not on every write.
+        self._size: Optional[int] = None
+
+    def _path(self, fields: Mapping[str, str]) -> str:
+        key = json.dumps(sorted(fields.items()), ensure_ascii=False)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def ttl_for(self, date: str) -> float:
+        if datetime.date.fromisoformat(date) < datetime.date.today():
+            return self.past_ttl
+        return self.ttl
+
+    def get(self, fields: Mapping[str, str]) -> Optional[CacheEntry]:
+        try:
+            with open(self._path(fields), encoding="utf-8") as cache_file:
+                content = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(
+            text=content["text"],
+            fetched_at=content["fetched_at"],
+            etag=content.get("etag"),
+            last_modified=content.get("last_modified"),
+            fresh_until=content.get("fresh_until"),
+            plan=content.get("plan"),
+        )
+
+    def put(
+        self,
+        fields: Mapping[str, str],
+        text: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        fresh_until: Optional[float] = None,
+        plan: Optional[Dict] = None,
+    ) -> None:
+        grown = self._write(
+            fields,
+            CacheEntry(
+                text=text,
+                fetched_at=time.time(),
+                etag=etag,
+                last_modified=last_modified,
+                fresh_until=fresh_until,
+                plan=plan,
+            ),
+        )
+        if self._size is not None:
+            self._size += grown
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def keep_fresh(self, fields: Mapping[str, str], until: float) -> bool:
+        # returns False if there is no entry to keep
+        entry = self.get(fields)
+        if entry is None:
+            return False
+        entry.fresh_until = until
+        grown = self._write(fields, entry)
+        if self._size is not None:
+            self._size += grown
+        return True
+
+    def _write(self, fields: Mapping[str, str], entry: CacheEntry) -> int:
+        # returns by how many bytes the cache has grown
+        import tempfile
+
+        os.makedirs(self.directory, exist_ok=True)
+        content = {
+            "fields": dict(fields),
+            "fetched_at": entry.fetched_at,
+            "etag": entry.etag,
+            "last_modified": entry.last_modified,
+            "text": entry.text,
+        }
+        if entry.fresh_until is not None:
+            content["fresh_until"] = entry.fresh_until
+        if entry.plan is not None:
+            content["plan"] = entry.plan
+        # write to a temporary file first so concurrent readers never see a
+        # partially written entry
+        path = self._path(fields)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            json.dump(content, tmp_file, ensure_ascii=False)
+        new_size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        return new_size - old_size
+
+    def evict(self) -> None:
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        if total_size > self.max_size:
+            # drop the least recently written entries first
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size * EVICT_TARGET:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_size -= size
+        self._size = total_size
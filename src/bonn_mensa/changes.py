@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from colorama import Fore, Style
+
+from bonn_mensa.mensa import PRICE_ATTRS, Category, PlanKey, meal_to_dict
+
+# (category, meal title, occurrence), the occurrence tells apart meals of the
+# same title within one category
+MealKey = Tuple[str, str, int]
+
+
+def default_snapshot_dir() -> str:
+    state_home = os.environ.get("XDG_STATE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "state"
+    )
+    return os.path.join(state_home, "bonn-mensa", "snapshots")
+
+
+def fingerprint(content: object) -> str:
+    encoded = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def plan_snapshot(categories: List[Category]) -> Dict:
+    # every meal is hashed once, the plan hash is built from the meal hashes
+    # so an unchanged plan is recognized without comparing single meals
+    meals = []
+    seen: Dict[Tuple[str, str], int] = {}
+    for cat in categories:
+        for meal in cat.meals:
+            occurrence = seen.get((cat.title, meal.title), 0)
+            seen[(cat.title, meal.title)] = occurrence + 1
+            content = meal_to_dict(meal)
+            meals.append(
+                {
+                    "category": cat.title,
+                    "occurrence": occurrence,
+                    "fingerprint": fingerprint(content),
+                    "meal": content,
+                }
+            )
+    return {
+        "fingerprint": fingerprint([meal["fingerprint"] for meal in meals]),
+        "meals": meals,
+    }
+
+
+class PlanChanges:
+    def __init__(
+        self,
+        added: List[Dict],
+        removed: List[Dict],
+        changed: List[Tuple[Dict, Dict]],
+    ) -> None:
+        # entries are meals of a snapshot, changed holds (old, new) pairs
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def to_dict(self) -> Dict:
+        return {
+            "added": [_meal_entry(entry) for entry in self.added],
+            "removed": [_meal_entry(entry) for entry in self.removed],
+            "changed": [
+                {
+                    **_meal_entry(new),
+                    "changes": {
+                        field: [old["meal"][field], value]
+                        for field, value in new["meal"].items()
+                        if old["meal"][field] != value
+                    },
+                }
+                for old, new in self.changed
+            ],
+        }
+
+
+def _meal_entry(entry: Dict) -> Dict:
+    return {"category": entry["category"], **entry["meal"]}
+
+
+def _meal_key(entry: Dict) -> MealKey:
+    return (entry["category"], entry["meal"]["title"], entry["occurrence"])
+
+
+def diff_snapshots(old: Optional[Dict], new: Dict) -> PlanChanges:
+    if old is None:
+        return PlanChanges(added=list(new["meals"]), removed=[], changed=[])
+    if old["fingerprint"] == new["fingerprint"]:
+        return PlanChanges(added=[], removed=[], changed=[])
+
+    old_meals = {_meal_key(entry): entry for entry in old["meals"]}
+    new_keys = set()
+    added = []
+    changed = []
+    for entry in new["meals"]:
+        key = _meal_key(entry)
+        new_keys.add(key)
+        previous = old_meals.get(key)
+        if previous is None:
+            added.append(entry)
+        elif previous["fingerprint"] != entry["fingerprint"]:
+            changed.append((previous, entry))
+    removed = [entry for entry in old["meals"] if _meal_key(entry) not in new_keys]
+    return PlanChanges(added=added, removed=removed, changed=changed)
+
+
+class SnapshotStore:
+    # keeps the last seen version of every plan, to tell what changed since
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.directory = directory or default_snapshot_dir()
+
+    def _path(self, key: PlanKey) -> str:
+        canteen, date, language = key
+        filename = f"{canteen.replace('/', '-')}_{date}_{language}.json"
+        return os.path.join(self.directory, filename)
+
+    def load(self, key: PlanKey) -> Optional[Dict]:
+        try:
+            with open(self._path(key), encoding="utf-8") as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key: PlanKey, snapshot: Dict) -> None:
+        import tempfile
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            json.dump(snapshot, tmp_file, ensure_ascii=False)
+        os.replace(tmp_path, self._path(key))
+
+    def update(self, key: PlanKey, categories: List[Category]) -> PlanChanges:
+        snapshot = plan_snapshot(categories)
+        previous = self.load(key)
+        changes = diff_snapshots(previous, snapshot)
+        if previous is None or changes:
+            self.save(key, snapshot)
+        return changes
+
+
+def _format_value(field: str, value: object) -> str:
+    if value is None:
+        return "-"
+    if field in PRICE_ATTRS.values():
+        return f"{value / 100:.2f}€"
+    if isinstance(value, list):
+        return ", ".join(value) or "-"
+    return str(value)
+
+
+def format_changes(key: PlanKey, changes: PlanChanges, colors: bool = True) -> str:
+    if colors:
+        HEADER_COLOR = Fore.MAGENTA
+        ADDED_COLOR = Fore.GREEN
+        REMOVED_COLOR = Fore.RED
+        CHANGED_COLOR = Fore.YELLOW
+        RESET_COLOR = Style.RESET_ALL
+    else:
+        HEADER_COLOR = ADDED_COLOR = REMOVED_COLOR = CHANGED_COLOR = RESET_COLOR = ""
+
+    canteen, date, language = key
+    lines = [f"{HEADER_COLOR}Mensa {canteen} – {date} [{language}]{RESET_COLOR}"]
+    for entry in changes.added:
+        lines.append(
+            f"{ADDED_COLOR}+ {entry['category']}: {entry['meal']['title']}{RESET_COLOR}"
+        )
+    for entry in changes.removed:
+        lines.append(
+            f"{REMOVED_COLOR}- {entry['category']}: {entry['meal']['title']}{RESET_COLOR}"
+        )
+    for old, new in changes.changed:
+        details = "; ".join(
+            f"{field} {_format_value(field, old['meal'][field])} → {_format_value(field, value)}"
+            for field, value in new["meal"].items()
+            if old["meal"][field] != value
+        )
+        lines.append(
+            f"{CHANGED_COLOR}~ {new['category']}: {new['meal']['title']} ({details}){RESET_COLOR}"
+        )
+    return "\n".join(lines) + "\n"
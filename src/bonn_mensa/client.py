@@ -0,0 +1,172 @@
+import threading
+import time
+from typing import TYPE_CHECKING, Mapping, Optional, Tuple, Union
+
+import bonn_mensa.version
+
+if TYPE_CHECKING:
+    import requests
+
+# (connect, read) in seconds, the meals endpoint regularly needs a few seconds
+DEFAULT_TIMEOUT: Tuple[float, float] = (5.0, 30.0)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_POOL_SIZE = 10
+# the key of the rate limit of hosts without a limit of their own
+ANY_HOST = "*"
+
+
+class HttpClient:
+    def __init__(
+        self,
+        timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        rate_limits: Optional[Mapping[str, "RateLimiter"]] = None,
+    ) -> None:
+        # requests is slow to import, so it is only loaded once a client is needed
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeout = timeout
+        # host name -> the limiter every request to it waits for
+        self.rate_limits = dict(rate_limits or {})
+
+        # the meal plan POST only reads data, so it is safe to retry it. An
+        # error status that lasts through all retries raises a RetryError
+        # instead of coming back as a response nobody checks.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "POST"}),
+            backoff_factor=backoff_factor,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+                "User-Agent": f"bonn-mensa/{bonn_mensa.version.__version__}",
+            }
+        )
+
+    def throttle(self, url: str) -> None:
+        if not self.rate_limits:
+            return
+        from urllib.parse import urlsplit
+
+        host = urlsplit(url).hostname
+        limiter = self.rate_limits.get(host) or self.rate_limits.get(ANY_HOST)
+        if limiter is not None:
+            limiter.wait()
+
+    def get(self, url: str, **kwargs) -> "requests.Response":
+        kwargs.setdefault("timeout", self.timeout)
+        self.throttle(url)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> "requests.Response":
+        kwargs.setdefault("timeout", self.timeout)
+        self.throttle(url)
+        return self.session.post(url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def take_token(
+    tokens: float, updated: float, now: float, rate: float, burst: float
+) -> Tuple[float, float]:
+    # the tokens left after taking one from a bucket that holds up to burst
+    # tokens and is refilled with rate tokens per second, and the seconds to
+    # wait until the token is there. The tokens go negative while requests
+    # wait, so every waiting request has its own slot.
+    tokens = min(burst, tokens + (now - updated) * rate) - 1
+    return tokens, max(0.0, -tokens / rate)
+
+
+class RateLimiter:
+    # a token bucket shared by all threads of the process. Up to burst
+    # requests are sent at once, after that at most rate per second. 0 means
+    # no limit.
+    def __init__(self, rate: float, burst: float = 1.0) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, delay = take_token(
+                self._tokens, self._updated, now, self.rate, self.burst
+            )
+            self._updated = now
+        if delay:
+            time.sleep(delay)
+
+
+class FileRateLimiter(RateLimiter):
+    # a token bucket shared by all processes on the machine using the same
+    # file, e.g. several services calling the API. The bucket is kept in the
+    # file, which is locked while a token is taken. Needs fcntl, so it only
+    # works on Unix.
+    def __init__(self, path: str, rate: float, burst: float = 1.0) -> None:
+        super().__init__(rate, burst)
+        self.path = path
+
+    def wait(self) -> None:
+        if self.rate <= 0:
+            return
+        import fcntl
+
+        # the lock of the file only covers other processes, the one of the
+        # bucket the threads of this process
+        with self._lock, open(self.path, "a+", encoding="utf-8") as bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            bucket_file.seek(0)
+            try:
+                tokens, updated = map(float, bucket_file.read().split())
+            except ValueError:
+                # a new or broken file starts with a full bucket
+                tokens, updated = self.burst, 0.0
+            # the clock has to be the same in all processes
+            now = time.time()
+            tokens, delay = take_token(tokens, updated, now, self.rate, self.burst)
+            bucket_file.seek(0)
+            bucket_file.truncate()
+            bucket_file.write(f"{tokens} {now}\n")
+        if delay:
+            time.sleep(delay)
+
+
+_default_client: Optional[HttpClient] = None
+_default_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
+
+
+def set_client(client: HttpClient) -> None:
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,275 @@
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Set, Tuple
+
+from bonn_mensa.mensa import (
+    PRICE_ATTRS,
+    Category,
+    Meal,
+    Vocabulary,
+    additive_vocabulary,
+    allergen_vocabulary,
+    get_remove_allergens,
+    info_code,
+)
+
+PRICE_ROLES = {price.lower(): attr for price, attr in PRICE_ATTRS.items()}
+CO2_TAGS = {
+    "green": "CO2_TAG_GREEN",
+    "orange": "CO2_TAG_ORANGE",
+    "red": "CO2_TAG_RED",
+}
+
+# field, operator, value
+Rule = Tuple[str, str, str]
+RULE_RE = re.compile(r"^\s*([a-z0-9_]+)\s*(<=|!=|!~|=|~)\s*(.*?)\s*$")
+
+FIELD_OPERATORS = {
+    "allergen": {"=", "!="},
+    "additive": {"=", "!="},
+    "category": {"!="},
+    "co2": {"="},
+    "title": {"~", "!~"},
+    "price": {"<="},
+    **{role: {"<="} for role in PRICE_ROLES},
+}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def parse_rule(text: str) -> Rule:
+    match = RULE_RE.match(text)
+    if match is None:
+        raise FilterError(f"Invalid filter rule {text!r}")
+    field, operator, value = match.groups()
+    if field not in FIELD_OPERATORS:
+        raise FilterError(f"Unknown filter field {field!r} in {text!r}")
+    if operator not in FIELD_OPERATORS[field]:
+        raise FilterError(f"Operator {operator} is not supported for {field!r}")
+    if not value:
+        raise FilterError(f"Missing value in filter rule {text!r}")
+
+    # values are checked here, so invalid rules are rejected while parsing
+    # the arguments and not once the plan has been fetched
+    if field == "title":
+        _compile_regex(value)
+    elif field == "co2":
+        _co2_tags(_split(value))
+    elif operator == "<=":
+        _parse_price(value)
+    return field, operator, value
+
+
+def _split(value: str) -> List[str]:
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def _parse_price(value: str) -> int:
+    try:
+        return round(float(value.replace(",", ".").rstrip("€")) * 100)
+    except ValueError:
+        raise FilterError(f"Invalid price {value!r}") from None
+
+
+def _compile_regex(value: str) -> Pattern:
+    try:
+        return re.compile(value, re.IGNORECASE)
+    except re.error as e:
+        raise FilterError(f"Invalid regular expression {value!r}: {e}") from None
+
+
+def _co2_tags(tags: Iterable[str]) -> Set[str]:
+    co2_tags = set()
+    for tag in tags:
+        if tag.lower() not in CO2_TAGS:
+            raise FilterError(f"Unknown CO2 tag {tag!r}")
+        co2_tags.add(CO2_TAGS[tag.lower()])
+    return co2_tags
+
+
+class TermMask:
+    # allergens and additives can be given by name in any language or by their
+    # code, e.g. "Milch (46)", "milk", "Milch" or "46". The names are resolved
+    # to codes and the codes to the bits of the vocabulary, ignoring case,
+    # again whenever the vocabulary has grown.
+    def __init__(self, vocabulary: Vocabulary, terms: Iterable[str]) -> None:
+        self.vocabulary = vocabulary
+        self.terms = {info_code(term).casefold() for term in terms}
+        self._size = -1
+        self._mask = 0
+
+    @property
+    def mask(self) -> int:
+        if self._size != self.vocabulary.size:
+            self._size = self.vocabulary.size
+            codes = {self.vocabulary.code(term).casefold() for term in self.terms}
+            self._mask = 0
+            for code, bit in self.vocabulary.items():
+                if code.casefold() in codes:
+                    self._mask |= bit
+        return self._mask
+
+
+class MealFilter:
+    # the rules are compiled once into a list of checks, ordered from cheap
+    # bit operations to regular expressions, which every meal has to pass
+    def __init__(
+        self,
+        exclude_allergens: Iterable[str] = (),
+        include_allergens: Iterable[Iterable[str]] = (),
+        exclude_additives: Iterable[str] = (),
+        include_additives: Iterable[Iterable[str]] = (),
+        exclude_categories: Iterable[str] = (),
+        max_prices: Optional[Dict[str, int]] = None,
+        co2_tags: Iterable[str] = (),
+        titles: Iterable[str] = (),
+        exclude_titles: Iterable[str] = (),
+    ) -> None:
+        # a meal has to contain one of the terms of every include group
+        self.exclude_categories: Set[str] = set(exclude_categories)
+        self._exclude_allergens = TermMask(allergen_vocabulary, exclude_allergens)
+        self._include_allergens = [
+            TermMask(allergen_vocabulary, terms) for terms in include_allergens
+        ]
+        self._exclude_additives = TermMask(additive_vocabulary, exclude_additives)
+        self._include_additives = [
+            TermMask(additive_vocabulary, terms) for terms in include_additives
+        ]
+        self._max_prices = dict(max_prices or {})
+        for role in self._max_prices:
+            if role not in PRICE_ROLES:
+                raise FilterError(f"Unknown price role {role!r}")
+        self._co2_tags = _co2_tags(co2_tags)
+        # every pattern is compiled on its own, since inline flags and
+        # backreferences do not survive being joined into one pattern
+        self._titles = [_compile_regex(title) for title in titles]
+        self._exclude_titles = [_compile_regex(title) for title in exclude_titles]
+        self._checks = self._compile()
+
+    @classmethod
+    def from_rules(
+        cls,
+        rules: Iterable[str],
+        language: str = "de",
+        filter_mode: Optional[str] = None,
+        gluten_free: bool = False,
+        exclude_categories: Iterable[str] = (),
+        price: str = "Student",
+    ) -> "MealFilter":
+        # the diet presets of the CLI are rules like any other
+        exclude_allergens = set(
+            get_remove_allergens(filter_mode, gluten_free, language)
+        )
+        include_allergens: List[List[str]] = []
+        exclude_additives: List[str] = []
+        include_additives: List[List[str]] = []
+        exclude_categories = list(exclude_categories)
+        max_prices: Dict[str, int] = {}
+        co2_tags: List[str] = []
+        titles: List[str] = []
+        exclude_titles: List[str] = []
+
+        for text in rules:
+            field, operator, value = parse_rule(text)
+            if field == "allergen" and operator == "!=":
+                exclude_allergens.update(_split(value))
+            elif field == "allergen":
+                include_allergens.append(_split(value))
+            elif field == "additive" and operator == "!=":
+                exclude_additives.extend(_split(value))
+            elif field == "additive":
+                include_additives.append(_split(value))
+            elif field == "category":
+                exclude_categories.extend(_split(value))
+            elif field == "co2":
+                co2_tags.extend(_split(value))
+            elif field == "title" and operator == "~":
+                titles.append(value)
+            elif field == "title":
+                exclude_titles.append(value)
+            else:
+                role = price.lower() if field == "price" else field
+                limit = _parse_price(value)
+                max_prices[role] = min(limit, max_prices.get(role, limit))
+
+        return cls(
+            exclude_allergens=exclude_allergens,
+            include_allergens=include_allergens,
+            exclude_additives=exclude_additives,
+            include_additives=include_additives,
+            exclude_categories=exclude_categories,
+            max_prices=max_prices,
+            co2_tags=co2_tags,
+            titles=titles,
+            exclude_titles=exclude_titles,
+        )
+
+    def _compile(self) -> List[Callable[[Meal], bool]]:
+        checks: List[Callable[[Meal], bool]] = []
+
+        if self._exclude_allergens.terms:
+            exclude_allergens = self._exclude_allergens
+            checks.append(lambda meal: not meal.allergen_mask & exclude_allergens.mask)
+        for term in self._include_allergens:
+            checks.append(lambda meal, term=term: bool(meal.allergen_mask & term.mask))
+        if self._exclude_additives.terms:
+            exclude_additives = self._exclude_additives
+            checks.append(lambda meal: not meal.additive_mask & exclude_additives.mask)
+        for term in self._include_additives:
+            checks.append(lambda meal, term=term: bool(meal.additive_mask & term.mask))
+
+        # meals without a price can not be shown to be cheap enough
+        for role, limit in self._max_prices.items():
+            attr = PRICE_ROLES[role]
+            checks.append(
+                lambda meal, attr=attr, limit=limit: (
+                    getattr(meal, attr) is not None and getattr(meal, attr) <= limit
+                )
+            )
+        if self._co2_tags:
+            co2_tags = self._co2_tags
+            checks.append(lambda meal: meal.co2_tag in co2_tags)
+
+        # several title rules all have to match
+        for title in self._titles:
+            checks.append(
+                lambda meal, title=title: title.search(meal.title) is not None
+            )
+        if self._exclude_titles:
+            exclude_titles = self._exclude_titles
+            checks.append(
+                lambda meal: not any(
+                    title.search(meal.title) for title in exclude_titles
+                )
+            )
+        return checks
+
+    def __call__(self, meal: Meal) -> bool:
+        for check in self._checks:
+            if not check(meal):
+                return False
+        return True
+
+    def hides_category(self, title: str) -> bool:
+        return title in self.exclude_categories
+
+    def filter_meals(self, meals: Iterable[Meal]) -> List[Meal]:
+        checks = self._checks
+        if not checks:
+            return list(meals)
+        return [meal for meal in meals if all(check(meal) for check in checks)]
+
+    def filter_plan(self, categories: Iterable[Category]) -> List[Category]:
+        # returns new categories with the matching meals, empty ones are left out
+        filtered = []
+        for cat in categories:
+            if cat.title in self.exclude_categories:
+                continue
+            meals = self.filter_meals(cat.meals)
+            if meals:
+                filtered_cat = Category(cat.title)
+                filtered_cat.meals = meals
+                filtered_cat.translations = cat.translations
+                filtered.append(filtered_cat)
+        return filtered
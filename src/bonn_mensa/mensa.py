@@ -1,18 +1,35 @@
 import argparse
+import functools
+import importlib
+import math
 import sys
+import threading
 from html.parser import HTMLParser
 import re
 import time
-from typing import Dict, List, Literal, Optional, Set, TypeAlias
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Set,
+    TextIO,
+    Tuple,
+    TypeAlias,
+)
 
-import argcomplete
-import requests
 from colorama import Fore, Style, init as colorama_init
-import xml.etree.ElementTree as ET
-
 
 import datetime
-import holidays
+
+# argcomplete, holidays, requests and xml are only imported by the code paths
+# that need them, which keeps --version and tab completion fast
 
 # simulates relative imports for the case where this script is run directly from the command line
 # -> behaves as if it was run as `python -m bonn_mensa.mensa`
@@ -24,8 +41,36 @@ if __package__ is None and not hasattr(sys, "frozen"):
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
 
 import bonn_mensa.version
+from bonn_mensa.cache import DEFAULT_TTL, CacheEntry, ResponseCache
+from bonn_mensa.client import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_RETRIES,
+    FileRateLimiter,
+    HttpClient,
+    RateLimiter,
+    get_client,
+    set_client,
+)
+from bonn_mensa.timing import Timings, get_timings, measure, set_timings
+
+if TYPE_CHECKING:
+    import xml.etree.ElementTree as ET
+
+    import holidays
+
+    from bonn_mensa.archive import MealArchive
+    from bonn_mensa.changes import SnapshotStore
+    from bonn_mensa.filters import MealFilter
 
 CO2Tag: TypeAlias = Literal["CO2_TAG_GREEN", "CO2_TAG_RED", "CO2_TAG_ORANGE"]
+# (canteen, date, language)
+PlanKey: TypeAlias = Tuple[str, str, str]
+
+MEALS_URL = "https://www.studierendenwerk-bonn.de/?type=1732731666"
+STREAM_CHUNK_SIZE = 4096
+# stored with the parsed plans in the cache and raised whenever the parser
+# changes how a response is parsed, so plans of older parsers are parsed again
+PARSER_REVISION = 2
 
 meat_allergens: Dict[str, Set[str]] = {
     "de": {
@@ -184,35 +229,215 @@ output_strs = {
 }
 
 
+INFO_CODE_RE = re.compile(r"\(([^()]+)\)\s*$")
+
+
+def info_code(info: str) -> str:
+    # allergens and additives end in a code that is the same in every
+    # language, e.g. "Milch (46)" and "milk (46)"
+    match = INFO_CODE_RE.search(info)
+    return match.group(1) if match else info
+
+
+class Vocabulary:
+    # assigns every distinct string one bit, so sets of allergens or additives
+    # can be stored and compared as a single integer
+    def __init__(self, words: Iterable[str] = ()) -> None:
+        self._bits: Dict[str, int] = {}
+        # the bit of every allergen or additive seen, e.g. "Milch (46)", and
+        # the code of every casefolded name, e.g. "milch" and "milk" -> "46"
+        self._info_bits: Dict[str, int] = {}
+        self._codes: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        for word in words:
+            self.info_bit(word)
+
+    def bit(self, word: str) -> int:
+        bit = self._bits.get(word)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.setdefault(sys.intern(word), 1 << len(self._bits))
+        return bit
+
+    def info_bit(self, info: str) -> int:
+        # the bit of the code of an allergen or additive. Its name is kept, so
+        # filters can refer to it by name in any language.
+        bit = self._info_bits.get(info)
+        if bit is None:
+            match = INFO_CODE_RE.search(info)
+            if match is None:
+                bit = self.bit(info)
+            else:
+                bit = self.bit(match.group(1))
+                name = info[: match.start()].strip().casefold()
+                with self._lock:
+                    self._codes.setdefault(name, match.group(1))
+            self._info_bits[info] = bit
+        return bit
+
+    def code(self, term: str) -> str:
+        # the code of an allergen or additive given by code or by name
+        code = info_code(term)
+        return self._codes.get(code.casefold(), code)
+
+    @property
+    def size(self) -> int:
+        # grows whenever a code or a name is added
+        return len(self._bits) + len(self._codes)
+
+    def mask(self, words: Iterable[str]) -> int:
+        mask = 0
+        for word in words:
+            mask |= self.bit(word)
+        return mask
+
+    def __len__(self) -> int:
+        return len(self._bits)
+
+    def items(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            return list(self._bits.items())
+
+
+# the vocabularies hold the codes, so masks do not depend on the language
+allergen_vocabulary = Vocabulary(
+    allergen
+    for table in (meat_allergens, ovo_lacto_allergens, gluten_allergens)
+    for language in sorted(table)
+    for allergen in sorted(table[language])
+)
+additive_vocabulary = Vocabulary()
+
+
+# the Meal attribute of the price of every role, keyed like --price
+PRICE_ATTRS = {
+    "Student": "student_price",
+    "Staff": "staff_price",
+    "Guest": "guest_price",
+}
+
+
 class Meal:
+    __slots__ = (
+        "title",
+        "allergens",
+        "additives",
+        "allergen_mask",
+        "additive_mask",
+        "student_price",
+        "staff_price",
+        "guest_price",
+        "co2_emission",
+        "co2_tag",
+        "translations",
+    )
+
     def __init__(self, title: str) -> None:
         self.title = title
         self.allergens: List[str] = []
         self.additives: List[str] = []
+        self.allergen_mask = 0
+        self.additive_mask = 0
         self.student_price: Optional[int] = None
         self.staff_price: Optional[int] = None
         self.guest_price: Optional[int] = None
         self.co2_emission: Optional[int] = None
         self.co2_tag: Optional[CO2Tag] = None
+        # titles in other languages, only set for bilingual plans
+        self.translations: Optional[Dict[str, str]] = None
+
+    @property
+    def allergen_codes(self) -> List[str]:
+        return [info_code(allergen) for allergen in self.allergens]
+
+    @property
+    def additive_codes(self) -> List[str]:
+        return [info_code(additive) for additive in self.additives]
 
     def add_allergen(self, allergen: str) -> None:
-        self.allergens.append(allergen)
+        self.allergens.append(sys.intern(allergen))
+        self.allergen_mask |= allergen_vocabulary.info_bit(allergen)
 
     def add_additive(self, additive: str) -> None:
-        self.additives.append(additive)
+        self.additives.append(sys.intern(additive))
+        self.additive_mask |= additive_vocabulary.info_bit(additive)
 
 
 class Category:
+    __slots__ = ("title", "meals", "translations")
+
     def __init__(self, title: str) -> None:
         self.title = title
         self.meals: List[Meal] = []
+        self.translations: Optional[Dict[str, str]] = None
 
     def add_meal(self, meal: Meal) -> None:
         self.meals.append(meal)
 
 
+CO2_EMISSION_RE = re.compile(r"^(\d+)g CO$")
+
+# the meal attribute of every price mode
+PRICE_MODES = {
+    f"NEW_PRICE_{price.upper()}": attr for price, attr in PRICE_ATTRS.items()
+}
+
+
+@functools.lru_cache(maxsize=None)
+def parser_tables(lang: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    # the modes following the headings of a language, looked up once per
+    # language instead of once per text node
+    info_modes = {
+        content_strings["NEW_INFOS_ALLERGENS"][lang]: "NEW_ALLERGENS",
+        content_strings["NEW_INFOS_ADDITIVES"][lang]: "NEW_ADDITIVES",
+    }
+    price_modes = {
+        content_strings["PRICE_CATEGORY_STUDENT"][lang]: "NEW_PRICE_STUDENT",
+        content_strings["PRICE_CATEGORY_STAFF"][lang]: "NEW_PRICE_STAFF",
+        content_strings["PRICE_CATEGORY_GUEST"][lang]: "NEW_PRICE_GUEST",
+    }
+    return info_modes, price_modes
+
+
+class ParseError:
+    # a text node the parser could not make sense of. The node is skipped,
+    # so one malformed meal does not break the rest of the plan.
+    __slots__ = ("mode", "tag", "data", "category", "meal")
+
+    def __init__(
+        self,
+        mode: str,
+        tag: Optional[str],
+        data: str,
+        category: Optional[str] = None,
+        meal: Optional[str] = None,
+    ) -> None:
+        self.mode = mode
+        self.tag = tag
+        self.data = data
+        self.category = category
+        self.meal = meal
+
+    def to_dict(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "tag": self.tag,
+            "data": self.data,
+            "category": self.category,
+            "meal": self.meal,
+        }
+
+    def __str__(self) -> str:
+        where = f" in meal {self.meal!r}" if self.meal else ""
+        if self.category:
+            where += f" in category {self.category!r}"
+        return f"Unexpected {self.data!r} after <{self.tag}> in mode {self.mode}{where}"
+
+
 class SimpleMensaResponseParser(HTMLParser):
-    def __init__(self, lang: str, verbose: bool = False):
+    # a state machine over the text nodes of a plan. The tags switch between
+    # modes, and every mode has a handler for the text that follows it.
+    def __init__(self, lang: str, verbose: bool = False, titles_only: bool = False):
         super().__init__()
         self.curr_category: Optional[Category] = None
         self.curr_meal: Optional[Meal] = None
@@ -220,10 +445,51 @@ class SimpleMensaResponseParser(HTMLParser):
         self.last_tag: Optional[str] = None
         self.last_nonignored_tag: Optional[str] = None
         self.categories: List[Category] = []
+        # the info text shown instead of a plan, e.g. if the canteen is closed
+        self.info: List[str] = []
+        self.errors: List[ParseError] = []
         self.mode = "INIT"
+        # the text since the last tag. A text node that spans two chunks of a
+        # streamed response arrives in two parts, so it is only handled once
+        # the next tag shows that it is complete.
+        self.text: List[str] = []
 
         self.lang = lang
         self.verbose = verbose
+        # only collect the titles of categories and meals, e.g. to translate
+        # a plan that was parsed in another language
+        self.titles_only = titles_only
+        self.info_modes, self.price_modes = parser_tables(lang)
+
+        # tags with attributes and all other tags are ignored
+        self.start_tag_handlers = {
+            "h2": self.start_new_category,
+            "h3": self.start_co2_emission,
+            "h5": self.start_new_meal,
+            "strong": self.start_new_infos,
+            "p": self.start_paragraph,
+            "th": self.start_new_price_category,
+            "td": self.keep_mode,
+            "br": self.keep_mode,
+        }
+        # the text of modes without a handler is ignored
+        self.data_handlers: Dict[str, Callable[[str], None]] = {
+            "NEW_CAT": self.handle_new_category,
+            "NEW_MEAL": self.handle_new_meal,
+        }
+        if not titles_only:
+            self.data_handlers.update(
+                {
+                    "INIT": self.handle_info,
+                    "INFO": self.handle_info,
+                    "NEW_INFOS": self.handle_new_infos,
+                    "CO2_EMISSION": self.handle_co2_emission,
+                    "NEW_ALLERGENS": self.handle_allergen,
+                    "NEW_ADDITIVES": self.handle_additive,
+                    "NEW_PRICE_CAT": self.handle_new_price_category,
+                    **{mode: self.handle_price for mode in PRICE_MODES},
+                }
+            )
 
     def start_new_category(self):
         if self.curr_category:
@@ -245,184 +511,1212 @@ class SimpleMensaResponseParser(HTMLParser):
 
         self.mode = "NEW_MEAL"
 
+    def start_co2_emission(self):
+        self.mode = "CO2_EMISSION"
+
+    def start_new_infos(self):
+        self.mode = "NEW_INFOS"
+
+    def start_paragraph(self):
+        if not self.curr_meal and not self.curr_category:
+            self.mode = "INFO"
+
+    def start_new_price_category(self):
+        self.mode = "NEW_PRICE_CAT"
+
+    def keep_mode(self):
+        pass
+
     def handle_starttag(self, tag, attrs):
+        self.flush_text()
         # skip non-empty attributes
-        if attrs or tag not in ["h2", "h3", "h5", "strong", "p", "th", "td", "br"]:
+        handler = None if attrs else self.start_tag_handlers.get(tag)
+        if handler is None:
             self.mode = "IGNORE"
             return
 
         self.last_nonignored_tag = tag
-        if tag == "h2":
-            self.start_new_category()
-        elif tag == "h3":
-            self.mode = "CO2_EMISSION"
-        elif tag == "h5":
-            self.start_new_meal()
-        elif tag == "strong":
-            self.mode = "NEW_INFOS"
-        elif tag == "p":
-            if not self.curr_meal and not self.curr_category:
-                self.mode = "INFO"
-        elif tag == "th":
-            self.mode = "NEW_PRICE_CAT"
-        elif tag == "td":
-            pass
+        handler()
+
+    def pop_categories(self) -> List[Category]:
+        # hands out the categories completed so far, e.g. while streaming
+        categories, self.categories = self.categories, []
+        return categories
 
     def parse_price(self, price: str) -> int:
         return int("".join(digit for digit in price if digit.isdigit()))
 
+    def error(self, data: str) -> None:
+        # records the text node and ignores the rest of it
+        self.errors.append(
+            ParseError(
+                self.mode,
+                self.last_nonignored_tag,
+                data,
+                category=self.curr_category.title if self.curr_category else None,
+                meal=self.curr_meal.title if self.curr_meal else None,
+            )
+        )
+        self.mode = "IGNORE"
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+
+    def handle_comment(self, data):
+        self.flush_text()
+
     def handle_data(self, data):
-        if self.mode == "IGNORE" or not data.strip():
+        self.text.append(data)
+
+    def flush_text(self) -> None:
+        if not self.text:
             return
-        if self.mode in ["INIT", "INFO"]:
-            print(data)
+        data = self.text[0] if len(self.text) == 1 else "".join(self.text)
+        self.text.clear()
+        handler = self.data_handlers.get(self.mode)
+        if handler is None or not data or data.isspace():
             return
+        handler(data)
+
+    def handle_info(self, data: str) -> None:
+        self.info.append(data)
+
+    def handle_new_category(self, data: str) -> None:
         data = data.strip()
-        if self.mode == "NEW_CAT":
-            self.curr_category = Category(data)
-            if self.verbose:
-                print(f"Creating new category {data}")
-        elif self.mode == "NEW_MEAL":
-            self.curr_meal = Meal(data)
-            if self.verbose:
-                print(f"\tCreating new meal {data}")
-        elif self.mode == "NEW_INFOS":
-            if data == content_strings["NEW_INFOS_ALLERGENS"][self.lang]:
-                self.mode = "NEW_ALLERGENS"
-            elif data == content_strings["NEW_INFOS_ADDITIVES"][self.lang]:
-                self.mode = "NEW_ADDITIVES"
-            elif data in co2_strings:
-                self.curr_meal.co2_tag = co2_strings[data]
-                self.mode = "IGNORE"
-            else:
-                raise NotImplementedError(f"Mode NEW_INFOS with data {data}")
-        elif self.mode == "CO2_EMISSION":
-            match = re.match(r"^(\d+)g CO$", data)
-            if match:
-                self.curr_meal.co2_emission = int(match.group(1))
-            else:
-                raise NotImplementedError(f"Mode CO2_EMISSION with data {data}")
-        elif self.mode == "NEW_ALLERGENS":
-            if self.verbose:
-                print(f"\t\tAdding new allergen: {data}")
-            self.curr_meal.add_allergen(data)
-        elif self.mode == "NEW_ADDITIVES":
-            if self.verbose:
-                print(f"\t\tAdding new additive: {data}")
-            self.curr_meal.add_additive(data)
-        elif self.mode == "NEW_PRICE_CAT":
-            if data == content_strings["PRICE_CATEGORY_STUDENT"][self.lang]:
-                self.mode = "NEW_PRICE_STUDENT"
-            elif data == content_strings["PRICE_CATEGORY_STAFF"][self.lang]:
-                self.mode = "NEW_PRICE_STAFF"
-            elif data == content_strings["PRICE_CATEGORY_GUEST"][self.lang]:
-                self.mode = "NEW_PRICE_GUEST"
-            else:
-                raise NotImplementedError(f"Mode NEW_PRICE_CAT with data {data}")
-        elif self.mode == "NEW_PRICE_STUDENT":
-            assert self.last_nonignored_tag == "td"
-            self.curr_meal.student_price = self.parse_price(data)
-        elif self.mode == "NEW_PRICE_STAFF":
-            assert self.last_nonignored_tag == "td"
-            self.curr_meal.staff_price = self.parse_price(data)
-        elif self.mode == "NEW_PRICE_GUEST":
-            assert self.last_nonignored_tag == "td"
-            self.curr_meal.guest_price = self.parse_price(data)
-        else:
-            raise NotImplementedError(f"{self.last_nonignored_tag} with data {data}")
+        self.curr_category = Category(data)
+        if self.verbose:
+            print(f"Creating new category {data}")
 
-    def to_xml(self, wCanteen) -> ET.Element:
-        # Define namespaces
-        ns = {
-            "": "http://openmensa.org/open-mensa-v2",
-            "xsi": "http://www.w3.org/2001/XMLSchema-instance",
-        }
-        # Register namespaces
-        for prefix, uri in ns.items():
-            ET.register_namespace(prefix, uri)
-
-        # Create the root element with namespaces
-        root = ET.Element(
-            "openmensa",
-            {
-                "version": "2.1",
-                "xmlns": ns[""],
-                "xmlns:xsi": ns["xsi"],
-                "xsi:schemaLocation": "http://openmensa.org/open-mensa-v2 http://openmensa.org/open-mensa-v2.xsd",
-            },
-        )
-        # Add version element
-        version = ET.SubElement(root, "version")
-        version.text = "5.04-4"
-
-        # Create the canteen and Date element
-        canteen = ET.SubElement(root, "canteen")
-        day = ET.SubElement(canteen, "day")
-        day.set("date", str(datetime.date.today()))
-
-        # Create the meals element
-
-        for cat in self.categories:
-            categories = ET.SubElement(day, "category")
-            categories.set("name", cat.title)
-            for meal in cat.meals:
-                meal_element = ET.SubElement(categories, "meal")
-                name = ET.SubElement(meal_element, "name")
-                name.text = meal.title
-                # Add allergens and Additives
-                allergens = ET.SubElement(meal_element, "note")
-                combined_list = meal.allergens + meal.additives
-                allergens.text = ", ".join(combined_list)
-                # Add prices
-                price = ET.SubElement(meal_element, "price")
-                price.set("role", "student")
-                price.text = str(f"{meal.student_price / 100:.2f}")
-                price = ET.SubElement(meal_element, "price")
-                price.set("role", "employee")
-                price.text = str(f"{meal.staff_price / 100:.2f}")
-                price = ET.SubElement(meal_element, "price")
-                price.set("role", "other")
-                price.text = str(f"{meal.guest_price / 100:.2f}")
+    def handle_new_meal(self, data: str) -> None:
+        data = data.strip()
+        self.curr_meal = Meal(data)
+        if self.verbose:
+            print(f"\tCreating new meal {data}")
 
-        return root
+    def handle_new_infos(self, data: str) -> None:
+        data = data.strip()
+        mode = self.info_modes.get(data)
+        if mode is not None:
+            self.mode = mode
+        elif data in co2_strings and self.curr_meal:
+            self.curr_meal.co2_tag = co2_strings[data]
+            self.mode = "IGNORE"
+        else:
+            self.error(data)
 
-    def to_pdf(self, wCanteen) -> None:
+    def handle_co2_emission(self, data: str) -> None:
+        data = data.strip()
+        match = CO2_EMISSION_RE.match(data)
+        if match and self.curr_meal:
+            self.curr_meal.co2_emission = int(match.group(1))
+        else:
+            self.error(data)
 
-        pdf_url = f"http://www.maxmanager.de/daten-extern/sw-bonn/pdf/wochenplaene/{canteen_id_dict_pdf[wCanteen]}/aktuell_de.pdf"
-        response = requests.get(pdf_url)
+    def handle_allergen(self, data: str) -> None:
+        data = data.strip()
+        if not self.curr_meal:
+            self.error(data)
+            return
+        if self.verbose:
+            print(f"\t\tAdding new allergen: {data}")
+        self.curr_meal.add_allergen(data)
 
-        if response.status_code == 200:
-            # Get Calenderweek for the plan
-            cw = datetime.datetime.today().isocalendar()[1]
-            filename = f"{wCanteen}_KW_{cw}_weekplan.pdf"
+    def handle_additive(self, data: str) -> None:
+        data = data.strip()
+        if not self.curr_meal:
+            self.error(data)
+            return
+        if self.verbose:
+            print(f"\t\tAdding new additive: {data}")
+        self.curr_meal.add_additive(data)
 
-            with open(filename, "wb") as pdf_file:
-                pdf_file.write(response.content)
-            print(f"PDF saved to {filename}")
+    def handle_new_price_category(self, data: str) -> None:
+        data = data.strip()
+        mode = self.price_modes.get(data)
+        if mode is None:
+            self.error(data)
         else:
-            print(f"Failed to download PDF. HTTP Status Code: {response.status_code}")
+            self.mode = mode
+
+    def handle_price(self, data: str) -> None:
+        data = data.strip()
+        if self.last_nonignored_tag != "td" or not self.curr_meal:
+            self.error(data)
+            return
+        try:
+            price = self.parse_price(data)
+        except ValueError:
+            self.error(data)
+            return
+        setattr(self.curr_meal, PRICE_MODES[self.mode], price)
+
+    def to_xml(self, wCanteen, date: Optional[str] = None) -> "ET.Element":
+        return meal_plan_to_xml(self.categories, wCanteen, date=date)
+
+    def to_pdf(self, wCanteen, client: Optional[HttpClient] = None) -> None:
+        # kept for compatibility, the download does not depend on the parser
+        from bonn_mensa.pdf import save_pdfs
+
+        save_pdfs([wCanteen], client=client)
 
     def close(self):
         super().close()
+        self.flush_text()
         self.start_new_category()
 
 
-def get_mensa_data() -> datetime.date:
-    print("Fetching mensa data...")
+# the OpenMensa role of every price
+OPENMENSA_PRICE_ROLES = {"Student": "student", "Staff": "employee", "Guest": "other"}
+OPENMENSA_NAMESPACES = {
+    "": "http://openmensa.org/open-mensa-v2",
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+}
+OPENMENSA_SCHEMA_LOCATION = (
+    "http://openmensa.org/open-mensa-v2 http://openmensa.org/open-mensa-v2.xsd"
+)
+OPENMENSA_PARSER_VERSION = "5.04-4"
+
+
+@functools.lru_cache(maxsize=None)
+def register_openmensa_namespaces() -> None:
+    import xml.etree.ElementTree as ET
+
+    for prefix, uri in OPENMENSA_NAMESPACES.items():
+        ET.register_namespace(prefix, uri)
+
+
+def meal_plan_to_xml(
+    categories: List[Category], wCanteen, date: Optional[str] = None
+) -> "ET.Element":
+    import xml.etree.ElementTree as ET
+
+    register_openmensa_namespaces()
+    ns = OPENMENSA_NAMESPACES
+
+    # Create the root element with namespaces
+    root = ET.Element(
+        "openmensa",
+        {
+            "version": "2.1",
+            "xmlns": ns[""],
+            "xmlns:xsi": ns["xsi"],
+            "xsi:schemaLocation": OPENMENSA_SCHEMA_LOCATION,
+        },
+    )
+    # Add version element
+    version = ET.SubElement(root, "version")
+    version.text = OPENMENSA_PARSER_VERSION
+
+    # Create the canteen and Date element
+    canteen = ET.SubElement(root, "canteen")
+    name = ET.SubElement(canteen, "name")
+    name.text = f"Mensa {wCanteen}"
+    day = ET.SubElement(canteen, "day")
+    day.set("date", date or str(datetime.date.today()))
+
+    # Create the meals element
+
+    for cat in categories:
+        categories_element = ET.SubElement(day, "category")
+        categories_element.set("name", cat.title)
+        for meal in cat.meals:
+            meal_element = ET.SubElement(categories_element, "meal")
+            name = ET.SubElement(meal_element, "name")
+            name.text = meal.title
+            # Add allergens and Additives
+            allergens = ET.SubElement(meal_element, "note")
+            combined_list = meal.allergens + meal.additives
+            allergens.text = ", ".join(combined_list)
+            # Add prices, a price that could not be parsed is left out
+            for price_name, role in OPENMENSA_PRICE_ROLES.items():
+                amount = getattr(meal, PRICE_ATTRS[price_name])
+                if amount is None:
+                    continue
+                price = ET.SubElement(meal_element, "price")
+                price.set("role", role)
+                price.text = f"{amount / 100:.2f}"
+
+    return root
+
+
+def save_xml(categories: List[Category], canteen: str, date: str) -> None:
+    import xml.etree.ElementTree as ET
+
+    xml_root = meal_plan_to_xml(categories, canteen, date=date)
+    xml_tree = ET.ElementTree(xml_root)
+    filename = f"{canteen.replace('/', '-')}_{date}_{time.time()}.xml"
+    xml_tree.write(filename, encoding="utf-8", xml_declaration=True, method="xml")
+    print(f"XML saved to {filename}")
+
+
+def meal_to_dict(meal: Meal) -> Dict:
+    meal_dict = {
+        "title": meal.title,
+        "allergens": list(meal.allergens),
+        "additives": list(meal.additives),
+        # prices are in cents
+        "student_price": meal.student_price,
+        "staff_price": meal.staff_price,
+        "guest_price": meal.guest_price,
+        "co2_emission": meal.co2_emission,
+        "co2_tag": meal.co2_tag,
+    }
+    if meal.translations:
+        meal_dict["translations"] = dict(meal.translations)
+    return meal_dict
+
+
+def category_to_dict(cat: Category) -> Dict:
+    cat_dict: Dict = {"title": cat.title}
+    if cat.translations:
+        cat_dict["translations"] = dict(cat.translations)
+    cat_dict["meals"] = [meal_to_dict(meal) for meal in cat.meals]
+    return cat_dict
+
+
+class Plan:
+    # the plan of a canteen on a day, as returned by fetch_plan. The library
+    # functions return it without printing anything, the CLI prints the info
+    # text and the errors and renders the categories.
+    __slots__ = (
+        "canteen",
+        "date",
+        "language",
+        "categories",
+        "info",
+        "errors",
+        "stale_age",
+        "error",
+    )
+
+    def __init__(
+        self,
+        canteen: str,
+        date: str,
+        language: str,
+        categories: Optional[List[Category]] = None,
+        info: Sequence[str] = (),
+        errors: Sequence[ParseError] = (),
+        stale_age: Optional[float] = None,
+        error: Optional[Exception] = None,
+    ) -> None:
+        self.canteen = canteen
+        self.date = date
+        self.language = language
+        self.categories: List[Category] = categories if categories is not None else []
+        # the info text shown instead of a plan, e.g. if the canteen is closed
+        self.info: List[str] = list(info)
+        # the parts of the response that could not be parsed and are missing
+        self.errors: List[ParseError] = list(errors)
+        # the age in seconds if this is the last good copy of a plan that
+        # could not be fetched, None if it is up to date
+        self.stale_age = stale_age
+        # why the plan could not be fetched, if it could not
+        self.error = error
+
+    @property
+    def key(self) -> PlanKey:
+        return (self.canteen, self.date, self.language)
+
+    @property
+    def meals(self) -> List[Meal]:
+        return [meal for cat in self.categories for meal in cat.meals]
+
+    def __bool__(self) -> bool:
+        return bool(self.categories)
+
+    def __repr__(self) -> str:
+        return f"Plan({self.canteen!r}, {self.date!r}, {self.language!r}, {len(self.meals)} meals)"
+
+    def filter(
+        self,
+        rules: Iterable[str] = (),
+        filter_mode: Optional[str] = None,
+        gluten_free: bool = False,
+        exclude_categories: Iterable[str] = (),
+        price: str = "Student",
+        meal_filter: Optional["MealFilter"] = None,
+    ) -> "Plan":
+        # a new plan with the matching meals, in the same rule syntax as
+        # --filter. Empty categories are left out.
+        from bonn_mensa.filters import MealFilter
+
+        if meal_filter is None:
+            meal_filter = MealFilter.from_rules(
+                rules,
+                language=self.language,
+                filter_mode=filter_mode,
+                gluten_free=gluten_free,
+                exclude_categories=exclude_categories,
+                price=price,
+            )
+        return Plan(
+            self.canteen,
+            self.date,
+            self.language,
+            meal_filter.filter_plan(self.categories),
+            info=self.info,
+            errors=self.errors,
+            stale_age=self.stale_age,
+            error=self.error,
+        )
+
+    def to_dict(self) -> Dict:
+        # like a plan of --json, without the codes of allergens and additives
+        from bonn_mensa.render import stale_fields
+
+        plan_dict = {
+            "canteen": self.canteen,
+            "date": self.date,
+            "language": self.language,
+            **stale_fields(self.stale_age),
+            "categories": [category_to_dict(cat) for cat in self.categories],
+        }
+        if self.info:
+            plan_dict["info"] = list(self.info)
+        return plan_dict
+
+
+@functools.lru_cache(maxsize=None)
+def get_nrw_holidays() -> "holidays.HolidayBase":
+    import holidays
+
     # Since the canteenes ar elocated in NRW get the public holidays for NRW
-    nrw_holidays = holidays.country_holidays("DE", subdiv="NW")
+    # building the calendar is expensive, so it is only done once
+    return holidays.country_holidays("DE", subdiv="NW")
+
+
+def is_open_day(day: datetime.date) -> bool:
+    # closures for operational reasons are not known in advance
+    return day.weekday() < 5 and day not in get_nrw_holidays()
 
+
+def get_mensa_data() -> datetime.date:
+    print("Fetching mensa data...")
     date = datetime.date.today()
     # Initialize the next working day as the day after today
     next_working_day = date + datetime.timedelta()
 
     # Loop until we find a day that is not a weekend or a public holiday
-    while next_working_day.weekday() >= 5 or next_working_day in nrw_holidays:
+    while not is_open_day(next_working_day):
         next_working_day += datetime.timedelta(days=1)
 
     return next_working_day
 
 
+def get_open_days(start: datetime.date, count: int) -> List[datetime.date]:
+    open_days: List[datetime.date] = []
+    day = start
+    while len(open_days) < count:
+        if is_open_day(day):
+            open_days.append(day)
+        day += datetime.timedelta(days=1)
+
+    return open_days
+
+
+def get_open_days_of_week(day: datetime.date) -> List[datetime.date]:
+    # on weekends the upcoming week is the interesting one
+    if day.weekday() >= 5:
+        day += datetime.timedelta(days=7 - day.weekday())
+    monday = day - datetime.timedelta(days=day.weekday())
+    week = (monday + datetime.timedelta(days=offset) for offset in range(5))
+    return [day for day in week if is_open_day(day)]
+
+
+def meal_plan_fields(date: str, canteen: str, language: str) -> Dict[str, str]:
+    return {
+        "tx_festwb_mealsajax[date]": date,
+        "tx_festwb_mealsajax[canteen]": canteen_id_dict[canteen],
+        "tx_festwb_mealsajax[language]": language_id_dict[language],
+    }
+
+
+def cached_plan(entry: CacheEntry) -> Optional[List[Category]]:
+    # the parsed plan kept with a cached response, None if the response has
+    # to be parsed, e.g. because it was cached by an older version
+    if entry.plan is None or entry.plan.get("parser") != PARSER_REVISION:
+        return None
+    from bonn_mensa.snapshot import SnapshotError, plan_from_snapshot
+
+    try:
+        return plan_from_snapshot(entry.plan)
+    except SnapshotError:
+        return None
+
+
+def iter_meal_plan(
+    date: str,
+    canteen: str,
+    language: str,
+    url: str = MEALS_URL,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    titles_only: bool = False,
+) -> Generator[Category, None, Plan]:
+    # yields the categories of a plan while it is parsed and returns the
+    # whole plan
+    client = client or get_client()
+    fields = meal_plan_fields(date, canteen, language)
+    parser = SimpleMensaResponseParser(
+        lang=language, verbose=verbose, titles_only=titles_only
+    )
+
+    # the time spent per stage is always measured, since perf_counter is cheap
+    # compared to a chunk of HTML, but only recorded when timings are collected
+    timings = get_timings()
+    key = (canteen, date, language)
+    parse_time = 0.0
+
+    start = time.perf_counter()
+    entry = cache.get(fields) if cache and not refresh else None
+    if timings and cache:
+        timings.add(key, "cache", time.perf_counter() - start)
+    # a cached response is only parsed again if its parsed plan is missing
+    categories: Optional[List[Category]] = None
+    # the categories handed out while streaming, to be kept with the response
+    parsed: List[Category] = []
+    # the validators of a response to cache
+    validators: Optional[Tuple[Optional[str], Optional[str]]] = None
+    if entry and entry.is_fresh(cache.ttl_for(date)):
+        if verbose:
+            print(f"Using cached response for {date=}, {canteen=}, {language=}")
+        start = time.perf_counter()
+        categories = cached_plan(entry)
+        if categories is None:
+            parser.feed(entry.text)
+        parse_time += time.perf_counter() - start
+    else:
+        headers = entry.revalidation_headers() if entry else {}
+        start = time.perf_counter()
+        with client.post(url, data=fields, headers=headers, stream=True) as r:
+            # connecting and waiting for the upstream until the headers arrive
+            if timings:
+                timings.add(key, "request", time.perf_counter() - start)
+            download_start = time.perf_counter()
+            if entry and r.status_code == 304:
+                if verbose:
+                    print(
+                        f"Cached response for {date=}, {canteen=}, {language=} is valid"
+                    )
+                start = time.perf_counter()
+                categories = cached_plan(entry)
+                if categories is None:
+                    parser.feed(entry.text)
+                parse_time += time.perf_counter() - start
+                chunks = [entry.text]
+            else:
+                # an error page is no plan, e.g. the "server is overloaded" text
+                # would be parsed as the info text of an empty plan
+                r.raise_for_status()
+                # feed the body to the parser while it is downloaded, so finished
+                # categories are handed out before the response is complete
+                r.encoding = r.encoding or "utf-8"
+                chunks = []
+                for chunk in r.iter_content(
+                    chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True
+                ):
+                    start = time.perf_counter()
+                    parser.feed(chunk)
+                    parse_time += time.perf_counter() - start
+                    finished = parser.pop_categories()
+                    parsed.extend(finished)
+                    if cache:
+                        chunks.append(chunk)
+                    yield from finished
+            # the body is parsed while it is downloaded, so the parse time is
+            # not counted as download time
+            if timings:
+                download_time = time.perf_counter() - download_start - parse_time
+                timings.add(key, "download", max(download_time, 0.0))
+
+            if cache and (r.status_code == 200 or entry and r.status_code == 304):
+                validators = (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+    plan_snapshot = None
+    info: Sequence[str] = ()
+    errors: Sequence[ParseError] = ()
+    if categories is None:
+        start = time.perf_counter()
+        parser.close()
+        categories = parser.pop_categories()
+        parse_time += time.perf_counter() - start
+        # the plan is returned without the parts that could not be parsed
+        info, errors = parser.info, parser.errors
+        # a titles only parse is not a complete plan
+        if validators is not None and not titles_only:
+            from bonn_mensa.snapshot import plan_to_snapshot
+
+            plan_snapshot = plan_to_snapshot(parsed + categories, info)
+            plan_snapshot["parser"] = PARSER_REVISION
+    else:
+        plan_snapshot = entry.plan
+        info = plan_snapshot.get("info", ())
+    if timings:
+        timings.add(key, "parse", parse_time)
+
+    if validators is not None:
+        cache.put(
+            fields,
+            "".join(chunks),
+            etag=validators[0],
+            last_modified=validators[1],
+            plan=plan_snapshot,
+        )
+    yield from categories
+    return Plan(canteen, date, language, parsed + categories, info=info, errors=errors)
+
+
+class Flight:
+    # a request for a plan that is in flight. Callers asking for the same plan
+    # in the meantime wait for its result instead of sending the same request.
+    __slots__ = ("future", "waiters")
+
+    def __init__(self) -> None:
+        from concurrent.futures import Future
+
+        # the snapshot of the plan and its errors, None if it has to be asked
+        # for again
+        self.future: "Future[Optional[Tuple[Dict, List[ParseError]]]]" = Future()
+        self.waiters = 0
+
+
+# (url, date, canteen, language, titles only, whether the cache may be used)
+FlightKey: TypeAlias = Tuple[str, str, str, str, bool, bool]
+
+_flights: Dict[FlightKey, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def land_flight(
+    key: FlightKey,
+    flight: Flight,
+    plan: Optional[Plan] = None,
+    error: Optional[BaseException] = None,
+) -> None:
+    with _flights_lock:
+        del _flights[key]
+        waiters = flight.waiters
+    if not waiters:
+        return
+    if plan is not None:
+        from bonn_mensa.snapshot import plan_to_snapshot
+
+        # the waiting callers get the plan as a snapshot and build their own
+        # objects from it, so no caller sees the changes of another
+        snapshot = plan_to_snapshot(plan.categories, plan.info)
+        flight.future.set_result((snapshot, plan.errors))
+    elif error is not None:
+        flight.future.set_exception(error)
+    else:
+        # the request was interrupted, so the others ask for the plan
+        # themselves
+        flight.future.set_result(None)
+
+
+def wait_for_flight(
+    flight: Flight, canteen: str, date: str, language: str
+) -> Optional[Plan]:
+    # the plan of a request of another caller, None if it was interrupted
+    start = time.perf_counter()
+    result = flight.future.result()
+    timings = get_timings()
+    if timings:
+        timings.add((canteen, date, language), "request", time.perf_counter() - start)
+    if result is None:
+        return None
+    from bonn_mensa.snapshot import plan_from_snapshot
+
+    snapshot, errors = result
+    return Plan(
+        canteen,
+        date,
+        language,
+        plan_from_snapshot(snapshot),
+        info=snapshot.get("info", ()),
+        errors=errors,
+    )
+
+
+def fetch_plan(
+    canteen: str,
+    date: Optional[str] = None,
+    language: str = "de",
+    url: str = MEALS_URL,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    title_languages: Sequence[str] = (),
+    titles_only: bool = False,
+    verbose: bool = False,
+) -> Plan:
+    # the plan of a canteen, by default on the next open day. Nothing is
+    # printed unless verbose is set, so it can be used as a library. Parsed
+    # plans are kept in the cache, so passing the same ResponseCache to every
+    # call reuses them across requests.
+    if date is None:
+        date = get_open_days(datetime.date.today(), 1)[0].isoformat()
+    if title_languages:
+        # the translated titles are fetched concurrently with the plan
+        return fetch_plans(
+            canteens=[canteen],
+            dates=[date],
+            languages=[language],
+            url=url,
+            max_workers=1 + len(title_languages),
+            verbose=verbose,
+            cache=cache,
+            refresh=refresh,
+            client=client,
+            title_languages=title_languages,
+        )[(canteen, date, language)]
+
+    # concurrent callers asking for the same plan share one request and its
+    # parsed result, e.g. the threads of a service that uses this as library.
+    # Only complete plans are shared, so a caller reading a plan slowly with
+    # iter_meal_plan never keeps others waiting.
+    key = (url, date, canteen, language, titles_only, cache is not None and not refresh)
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is None:
+            _flights[key] = own = Flight()
+        else:
+            flight.waiters += 1
+
+    if flight is not None:
+        if verbose:
+            print(f"Waiting for the request of {date=}, {canteen=}, {language=}")
+        plan = wait_for_flight(flight, canteen, date, language)
+        if plan is not None:
+            return plan
+
+    categories = iter_meal_plan(
+        date=date,
+        canteen=canteen,
+        language=language,
+        url=url,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        titles_only=titles_only,
+    )
+    try:
+        # the plan is the return value of the generator
+        while True:
+            try:
+                next(categories)
+            except StopIteration as stop:
+                plan = stop.value
+                break
+    except Exception as e:
+        if flight is None:
+            land_flight(key, own, error=e)
+        raise
+    except BaseException:
+        # e.g. KeyboardInterrupt
+        if flight is None:
+            land_flight(key, own)
+        raise
+    if flight is None:
+        land_flight(key, own, plan=plan)
+    return plan
+
+
+def fetch_meal_plan(
+    date: str,
+    canteen: str,
+    language: str,
+    url: str = MEALS_URL,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    titles_only: bool = False,
+) -> List[Category]:
+    return fetch_plan(
+        canteen,
+        date,
+        language,
+        url=url,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        titles_only=titles_only,
+    ).categories
+
+
+def fetch_meal_plan_html(
+    date: str,
+    canteen: str,
+    language: str,
+    url: str = MEALS_URL,
+    client: Optional[HttpClient] = None,
+) -> str:
+    # the response without parsing it, e.g. to parse it in another process
+    client = client or get_client()
+    with client.post(url, data=meal_plan_fields(date, canteen, language)) as r:
+        r.raise_for_status()
+        r.encoding = r.encoding or "utf-8"
+        return r.text
+
+
+def merge_translations(
+    categories: List[Category], translated: List[Category], language: str
+) -> None:
+    # both plans list the same categories and meals in the same order, only
+    # the titles differ. If they do not line up, e.g. because the plan was
+    # changed in between, nothing is translated rather than the wrong meal.
+    if len(categories) != len(translated):
+        return
+    for cat, translated_cat in zip(categories, translated):
+        if len(cat.meals) != len(translated_cat.meals):
+            continue
+        cat.translations = cat.translations or {}
+        cat.translations[language] = translated_cat.title
+        for meal, translated_meal in zip(cat.meals, translated_cat.meals):
+            meal.translations = meal.translations or {}
+            meal.translations[language] = translated_meal.title
+
+
+def iter_plans(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    languages: Iterable[str],
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    title_languages: Iterable[str] = (),
+) -> Iterator[Plan]:
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # all requests share one connection pool, so connections are reused
+    # instead of paying the TLS handshake for every canteen and date
+    client = client or get_client()
+    title_languages = list(title_languages)
+    # every request is independent, so they are sent concurrently and at most
+    # max_workers of them are in flight at the same time
+    keys = [
+        (canteen, date, language)
+        for canteen in canteens
+        for date in dates
+        for language in languages
+    ]
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # (key, None) for a plan, (key, language) for the titles of a plan in
+        # another language, which only need a titles only parse
+        futures = {}
+        for key in keys:
+            for title_language in [None, *title_languages]:
+                if title_language == key[2]:
+                    continue
+                future = executor.submit(
+                    fetch_plan,
+                    canteen=key[0],
+                    date=key[1],
+                    language=title_language or key[2],
+                    url=url,
+                    verbose=verbose,
+                    cache=cache,
+                    refresh=refresh,
+                    client=client,
+                    titles_only=title_language is not None,
+                )
+                futures[future] = (key, title_language)
+
+        pending: Dict[PlanKey, int] = {}
+        for key, _ in futures.values():
+            pending[key] = pending.get(key, 0) + 1
+        plans: Dict[PlanKey, Plan] = {}
+        translations: Dict[PlanKey, Dict[str, Plan]] = {}
+
+        # plans are handed out in the order they arrive, once their
+        # translations are complete
+        for future in as_completed(futures):
+            key, title_language = futures[future]
+            if title_language is None:
+                plans[key] = future.result()
+            else:
+                translations.setdefault(key, {})[title_language] = future.result()
+            pending[key] -= 1
+            if pending[key]:
+                continue
+            plan = plans.pop(key)
+            for title_language, translated in translations.pop(key, {}).items():
+                merge_translations(
+                    plan.categories, translated.categories, title_language
+                )
+            yield plan
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_meal_plans(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    languages: Iterable[str],
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    title_languages: Iterable[str] = (),
+) -> Iterator[Tuple[PlanKey, List[Category]]]:
+    for plan in iter_plans(
+        canteens=canteens,
+        dates=dates,
+        languages=languages,
+        url=url,
+        max_workers=max_workers,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        title_languages=title_languages,
+    ):
+        yield plan.key, plan.categories
+
+
+def fetch_plans(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    languages: Iterable[str],
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    title_languages: Iterable[str] = (),
+) -> Dict[PlanKey, Plan]:
+    canteens, dates, languages = list(canteens), list(dates), list(languages)
+    plans = {
+        plan.key: plan
+        for plan in iter_plans(
+            canteens=canteens,
+            dates=dates,
+            languages=languages,
+            url=url,
+            max_workers=max_workers,
+            verbose=verbose,
+            cache=cache,
+            refresh=refresh,
+            client=client,
+            title_languages=title_languages,
+        )
+    }
+    # keep the order of the query instead of the order of arrival
+    return {
+        (canteen, date, language): plans[(canteen, date, language)]
+        for canteen in canteens
+        for date in dates
+        for language in languages
+    }
+
+
+def fetch_meal_plans(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    languages: Iterable[str],
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    title_languages: Iterable[str] = (),
+) -> Dict[PlanKey, List[Category]]:
+    plans = fetch_plans(
+        canteens=canteens,
+        dates=dates,
+        languages=languages,
+        url=url,
+        max_workers=max_workers,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        title_languages=title_languages,
+    )
+    return {key: plan.categories for key, plan in plans.items()}
+
+
+def last_good_plan(
+    date: str,
+    canteen: str,
+    language: str,
+    cache: Optional[ResponseCache] = None,
+    archive: Optional["MealArchive"] = None,
+) -> Optional[Plan]:
+    # the last copy of a plan that could be fetched, however old it is. Its age
+    # is infinite if it was archived before the archive recorded the time.
+    if cache is not None:
+        entry = cache.get(meal_plan_fields(date, canteen, language))
+        if entry is not None:
+            categories = cached_plan(entry)
+            if categories is None:
+                parser = SimpleMensaResponseParser(lang=language)
+                parser.feed(entry.text)
+                parser.close()
+                categories = parser.categories
+            if categories:
+                return Plan(canteen, date, language, categories, stale_age=entry.age)
+    if archive is not None:
+        categories = archive.load_plan(canteen, date, language)
+        if categories:
+            stored_at = archive.stored_at(canteen, date, language)
+            age = math.inf if stored_at is None else time.time() - stored_at
+            return Plan(canteen, date, language, categories, stale_age=age)
+    return None
+
+
+def iter_meal_plans_or_stale(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    language: str,
+    max_wait: Optional[float] = None,
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    archive: Optional["MealArchive"] = None,
+    title_languages: Sequence[str] = (),
+) -> Iterator[Tuple[PlanKey, Plan]]:
+    # like iter_meal_plans, but a plan that could not be fetched, or not
+    # within max_wait seconds, is replaced by its last good copy
+    client = client or get_client()
+    keys = [(canteen, date, language) for canteen in canteens for date in dates]
+    title_languages = [lang for lang in title_languages if lang != language]
+    # (key, None) for a plan, (key, language) for its titles in another
+    # language. All of them share the max_workers threads, so --bilingual
+    # does not send more requests at once.
+    pending: List[Tuple[PlanKey, Optional[str]]] = [
+        (key, title_language)
+        for key in keys
+        for title_language in [None, *title_languages]
+    ]
+    # the plans and titles still missing, and the ones that arrived
+    missing = {key: 1 + len(title_languages) for key in keys}
+    plans: Dict[PlanKey, Plan] = {}
+    translations: Dict[PlanKey, Dict[str, Plan]] = {}
+    results: Dict[PlanKey, Plan] = {}
+    done = threading.Condition()
+
+    def worker() -> None:
+        while True:
+            with done:
+                if not pending:
+                    return
+                key, title_language = pending.pop(0)
+            canteen, date, _ = key
+            try:
+                plan = fetch_plan(
+                    canteen,
+                    date,
+                    title_language or language,
+                    url=url,
+                    cache=cache,
+                    refresh=refresh,
+                    client=client,
+                    titles_only=title_language is not None,
+                    verbose=verbose,
+                )
+            except Exception as e:
+                # missing titles only leave the plan untranslated
+                plan = Plan(canteen, date, language, error=e)
+            with done:
+                if title_language is None:
+                    plans[key] = plan
+                else:
+                    translations.setdefault(key, {})[title_language] = plan
+                missing[key] -= 1
+                if missing[key]:
+                    continue
+                plan = plans.pop(key)
+                for title_language, translated in translations.pop(key, {}).items():
+                    merge_translations(
+                        plan.categories, translated.categories, title_language
+                    )
+                results[key] = plan
+                done.notify_all()
+
+    def resolve(key: PlanKey) -> Plan:
+        plan = results[key]
+        if plan:
+            return plan
+        canteen, date, _ = key
+        stale = last_good_plan(date, canteen, language, cache=cache, archive=archive)
+        if stale is not None:
+            if plan.error is None:
+                # e.g. the reason the canteen is closed
+                stale.info = plan.info
+            else:
+                # the text of a failed fetch is no news about the plan
+                stale.error = plan.error
+            return stale
+        return plan
+
+    # the plans are fetched by daemon threads, which keep neither the output
+    # nor the exit waiting once the budget is used up. A response arriving
+    # later is still cached, so the next run is up to date.
+    for _ in range(max(1, min(max_workers, len(pending)))):
+        threading.Thread(target=worker, daemon=True).start()
+
+    deadline = None if max_wait is None else time.monotonic() + max_wait
+    remaining = list(keys)
+    while remaining:
+        with done:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done.wait_for(
+                lambda: any(key in results for key in remaining), timeout=timeout
+            )
+            arrived = [key for key in remaining if key in results]
+        if not arrived:
+            break
+        for key in arrived:
+            remaining.remove(key)
+            yield key, resolve(key)
+
+    for key in remaining:
+        canteen, date, _ = key
+        stale = last_good_plan(date, canteen, language, cache=cache, archive=archive)
+        if stale is not None:
+            yield key, stale
+            continue
+        # without a copy to fall back to, the response is the best there is
+        with done:
+            done.wait_for(lambda: key in results)
+        yield key, resolve(key)
+
+
+def fetch_meal_plans_or_stale(
+    canteens: Iterable[str],
+    dates: Iterable[str],
+    language: str,
+    max_wait: Optional[float] = None,
+    url: str = MEALS_URL,
+    max_workers: int = 4,
+    verbose: bool = False,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    client: Optional[HttpClient] = None,
+    archive: Optional["MealArchive"] = None,
+    title_languages: Sequence[str] = (),
+) -> Dict[PlanKey, Plan]:
+    canteens, dates = list(canteens), list(dates)
+    plans = dict(
+        iter_meal_plans_or_stale(
+            canteens=canteens,
+            dates=dates,
+            language=language,
+            max_wait=max_wait,
+            url=url,
+            max_workers=max_workers,
+            verbose=verbose,
+            cache=cache,
+            refresh=refresh,
+            client=client,
+            archive=archive,
+            title_languages=title_languages,
+        )
+    )
+    # keep the order of the query instead of the order of arrival
+    return {
+        (canteen, date, language): plans[(canteen, date, language)]
+        for canteen in canteens
+        for date in dates
+    }
+
+
+def get_remove_allergens(
+    filter_mode: Optional[str], gluten_free: bool, language: str
+) -> Set[str]:
+    if filter_mode is None:
+        remove_allergens = set()
+    elif filter_mode == "vegetarian":
+        remove_allergens = set(meat_allergens[language])
+    elif filter_mode == "vegan":
+        remove_allergens = meat_allergens[language] | ovo_lacto_allergens[language]
+    else:
+        raise NotImplementedError(filter_mode)
+
+    if gluten_free:
+        remove_allergens.update(gluten_allergens[language])
+
+    return remove_allergens
+
+
+def print_plan_errors(plan: Plan) -> None:
+    # why the plan could not be fetched and the parts of it that could not be
+    # parsed. The info text is rendered with the plan.
+    if plan.error is not None:
+        print(f"Querying {plan.canteen} for {plan.date} failed: {plan.error}")
+    for error in plan.errors:
+        print(
+            f"Could not parse {plan.canteen} on {plan.date}: {error}", file=sys.stderr
+        )
+
+
+def print_meal_plan(
+    categories: List[Category],
+    date: str,
+    canteen: str,
+    filtered_categories: List[str],
+    language: str,
+    filter_mode: Optional[str] = None,
+    show_all_allergens: bool = False,
+    show_additives: bool = False,
+    show_co2: bool = False,
+    gluten_free: bool = False,
+    price: str = "Student",
+    colors: bool = True,
+    markdown_output: bool = False,
+    json_output: bool = False,
+    ndjson_output: bool = False,
+    meal_filter: Optional["MealFilter"] = None,
+    stale_age: Optional[float] = None,
+    info: Sequence[str] = (),
+    file: Optional[TextIO] = None,
+) -> bool:
+    from bonn_mensa.render import get_renderer, render_plan
+
+    renderer = get_renderer(
+        language,
+        markdown_output=markdown_output,
+        json_output=json_output,
+        ndjson_output=ndjson_output,
+        colors=colors,
+        filtered_categories=filtered_categories,
+        filter_mode=filter_mode,
+        show_all_allergens=show_all_allergens,
+        show_additives=show_additives,
+        show_co2=show_co2,
+        gluten_free=gluten_free,
+        price=price,
+        meal_filter=meal_filter,
+    )
+    success = render_plan(
+        renderer,
+        categories,
+        date=date,
+        canteen=canteen,
+        stale_age=stale_age,
+        info=info,
+    )
+    renderer.flush(file)
+    return success
+
+
 def query_mensa(
     date: Optional[str],
     canteen: str,
@@ -433,215 +1727,360 @@ def query_mensa(
     show_additives: bool = False,
     show_co2: bool = False,
     gluten_free: bool = False,
-    url: str = "https://www.studierendenwerk-bonn.de/?type=1732731666",
+    url: str = MEALS_URL,
     verbose: bool = False,
     price: str = "Student",
     colors: bool = True,
     markdown_output: bool = False,
+    json_output: bool = False,
+    ndjson_output: bool = False,
+    meal_filter: Optional["MealFilter"] = None,
+    title_languages: Sequence[str] = (),
     xml_output: bool = False,
     pdf: bool = False,
+    max_workers: int = 4,
+    max_wait: Optional[float] = None,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    archive: Optional["MealArchive"] = None,
+    client: Optional[HttpClient] = None,
+    snapshot: Optional[str] = None,
+    file: Optional[TextIO] = None,
 ) -> None:
     if date is None:
         # If no date is provided get next valid day i.E. working days from monday to fridy
         # this does not take into account closures due to operational reasons
         date = get_mensa_data().strftime("%Y-%m-%d")
 
-    if colors:
-        QUERY_COLOR = Fore.MAGENTA
-        CATEGORY_COLOR = Fore.GREEN
-        MEAL_COLOR = Fore.BLUE
-        PRICE_COLOR = Fore.CYAN
-        ALLERGEN_COLOR = Fore.RED
-        ADDITIVE_COLOR = Fore.YELLOW
-        WARN_COLOR = Fore.RED
-        RESET_COLOR = Style.RESET_ALL
-        CO2_COLORS = {
-            "CO2_TAG_GREEN": Fore.LIGHTGREEN_EX,
-            "CO2_TAG_ORANGE": Fore.LIGHTYELLOW_EX,
-            "CO2_TAG_RED": Fore.LIGHTRED_EX,
-        }
-    else:
-        QUERY_COLOR = ""
-        CATEGORY_COLOR = ""
-        MEAL_COLOR = ""
-        PRICE_COLOR = ""
-        ALLERGEN_COLOR = ""
-        ADDITIVE_COLOR = ""
-        WARN_COLOR = ""
-        RESET_COLOR = ""
-        CO2_COLORS = {
-            "CO2_TAG_GREEN": "",
-            "CO2_TAG_ORANGE": "",
-            "CO2_TAG_RED": "",
-        }
-
-    filter_str = f" [{filter_mode}]" if filter_mode else ""
-    if markdown_output:
-        print(f"### Mensa {canteen} – {date}{filter_str} [{language}]\n")
-    else:
-        print(
-            f"{QUERY_COLOR}Mensa {canteen} – {date}{filter_str} [{language}]{RESET_COLOR}"
-        )
-
     if verbose:
         print(
             f"Querying for {date=}, {canteen=}, {filtered_categories=}, {filter_mode=}, {url=}"
         )
-    r = requests.post(
-        url,
-        data={
-            "tx_festwb_mealsajax[date]": date,
-            "tx_festwb_mealsajax[canteen]": canteen_id_dict[canteen],
-            "tx_festwb_mealsajax[language]": language_id_dict[language],
-        },
-    )
-    parser = SimpleMensaResponseParser(lang=language, verbose=verbose)
-    parser.feed(r.text)
-    parser.close()
+    plan = fetch_meal_plans_or_stale(
+        canteens=[canteen],
+        dates=[date],
+        language=language,
+        max_wait=max_wait,
+        url=url,
+        # the titles in the other languages are fetched alongside the plan
+        max_workers=min(max_workers, 1 + len(title_languages)),
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        archive=archive,
+        title_languages=title_languages,
+    )[(canteen, date, language)]
+    print_plan_errors(plan)
+    categories, stale_age = plan.categories, plan.stale_age
+    if archive is not None and categories and stale_age is None:
+        archive.store(canteen, date, language, categories)
+    if snapshot and categories:
+        from bonn_mensa.snapshot import save_snapshot
+
+        save_snapshot(snapshot, [((canteen, date, language), categories)])
+        print(f"Snapshot saved to {snapshot}")
+
+    if not print_meal_plan(
+        categories,
+        date=date,
+        canteen=canteen,
+        filtered_categories=filtered_categories,
+        language=language,
+        filter_mode=filter_mode,
+        show_all_allergens=show_all_allergens,
+        show_additives=show_additives,
+        show_co2=show_co2,
+        gluten_free=gluten_free,
+        price=price,
+        colors=colors,
+        markdown_output=markdown_output,
+        json_output=json_output,
+        ndjson_output=ndjson_output,
+        meal_filter=meal_filter,
+        stale_age=stale_age,
+        info=plan.info,
+        file=file,
+    ):
+        return
 
-    if not parser.categories:
-        print(
-            f"{WARN_COLOR}Query failed. Please check https://www.studierendenwerk-bonn.de if the mensa is open today.{RESET_COLOR}"
+    if xml_output:
+        with measure((canteen, date, language), "export"):
+            save_xml(categories, canteen, date)
+    if pdf:
+        from bonn_mensa.pdf import save_pdfs
+
+        save_pdfs([canteen], client=client)
+
+
+def query_mensas(
+    dates: List[str],
+    canteens: List[str],
+    filtered_categories: List[str],
+    language: str,
+    filter_mode: Optional[str] = None,
+    show_all_allergens: bool = False,
+    show_additives: bool = False,
+    show_co2: bool = False,
+    gluten_free: bool = False,
+    url: str = MEALS_URL,
+    verbose: bool = False,
+    price: str = "Student",
+    colors: bool = True,
+    markdown_output: bool = False,
+    json_output: bool = False,
+    ndjson_output: bool = False,
+    meal_filter: Optional["MealFilter"] = None,
+    title_languages: Sequence[str] = (),
+    xml_output: bool = False,
+    pdf: bool = False,
+    max_workers: int = 4,
+    max_wait: Optional[float] = None,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    archive: Optional["MealArchive"] = None,
+    client: Optional[HttpClient] = None,
+    snapshot: Optional[str] = None,
+    snapshot_plans: Optional[Dict[PlanKey, List[Category]]] = None,
+    file: Optional[TextIO] = None,
+) -> None:
+    from bonn_mensa.render import get_renderer, render_plan
+
+    renderer = get_renderer(
+        language,
+        markdown_output=markdown_output,
+        json_output=json_output,
+        ndjson_output=ndjson_output,
+        colors=colors,
+        filtered_categories=filtered_categories,
+        filter_mode=filter_mode,
+        show_all_allergens=show_all_allergens,
+        show_additives=show_additives,
+        show_co2=show_co2,
+        gluten_free=gluten_free,
+        price=price,
+        meal_filter=meal_filter,
+    )
+    plan_args = dict(
+        canteens=canteens,
+        dates=dates,
+        language=language,
+        max_wait=max_wait,
+        url=url,
+        max_workers=max_workers,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
+        archive=archive,
+        title_languages=title_languages,
+    )
+    plans: Iterable[Tuple[PlanKey, Plan]]
+    if snapshot_plans is not None:
+        # the plans were parsed before, nothing is queried
+        plans = (
+            (key, Plan(*key, categories)) for key, categories in snapshot_plans.items()
         )
-        return
-    print()
+    elif renderer.streaming:
+        # every plan is written as soon as it arrives
+        plans = iter_meal_plans_or_stale(**plan_args)
+    else:
+        # the whole report is rendered into one buffer and written at once
+        plans = fetch_meal_plans_or_stale(**plan_args).items()
+
+    rendered = []
+    parsed = []
+    for (canteen, date, _), plan in plans:
+        print_plan_errors(plan)
+        categories, stale_age = plan.categories, plan.stale_age
+        # a stale copy is already archived
+        if archive is not None and categories and stale_age is None:
+            archive.store(canteen, date, language, categories)
+        if snapshot and categories:
+            parsed.append(((canteen, date, language), categories))
+        if render_plan(
+            renderer,
+            categories,
+            date=date,
+            canteen=canteen,
+            stale_age=stale_age,
+            info=plan.info,
+        ):
+            renderer.write(renderer.plan_separator)
+            rendered.append((canteen, date, categories))
+        if renderer.streaming:
+            renderer.flush(file)
+    renderer.flush(file)
+
+    if snapshot:
+        from bonn_mensa.snapshot import save_snapshot
+
+        save_snapshot(snapshot, parsed)
+        print(f"Snapshot saved to {snapshot}")
 
-    queried_categories = [
-        cat for cat in parser.categories if cat.title not in filtered_categories
-    ]
-    if not queried_categories:
-        return
+    if xml_output:
+        for canteen, date, categories in rendered:
+            with measure((canteen, date, language), "export"):
+                save_xml(categories, canteen, date)
 
-    interesting_allergens = (
-        meat_allergens[language]
-        | ovo_lacto_allergens[language]
-        | other_allergens[language]
+    if pdf:
+        from bonn_mensa.pdf import save_pdfs
+
+        save_pdfs(canteens, max_workers=max_workers, client=client)
+
+
+def query_changes(
+    dates: List[str],
+    canteens: List[str],
+    language: str,
+    url: str = MEALS_URL,
+    verbose: bool = False,
+    colors: bool = True,
+    xml_output: bool = False,
+    max_workers: int = 4,
+    cache: Optional[ResponseCache] = None,
+    refresh: bool = False,
+    archive: Optional["MealArchive"] = None,
+    client: Optional[HttpClient] = None,
+    snapshots: Optional["SnapshotStore"] = None,
+    json_output: bool = False,
+    file: Optional[TextIO] = None,
+) -> bool:
+    import json
+
+    from bonn_mensa.changes import SnapshotStore, format_changes
+
+    file = file or sys.stdout
+    snapshots = snapshots or SnapshotStore()
+    plans = fetch_meal_plans(
+        canteens=canteens,
+        dates=dates,
+        languages=[language],
+        url=url,
+        max_workers=max_workers,
+        verbose=verbose,
+        cache=cache,
+        refresh=refresh,
+        client=client,
     )
 
-    if filter_mode is None:
-        remove_allergens = set()
-    elif filter_mode == "vegetarian":
-        remove_allergens = meat_allergens[language]
-    elif filter_mode == "vegan":
-        remove_allergens = meat_allergens[language] | ovo_lacto_allergens[language]
+    # only changed plans are printed, archived and saved, an unchanged plan
+    # costs nothing beyond its fetch and one hash comparison
+    changed = False
+    for key, categories in plans.items():
+        # a failed query says nothing about the plan, so it is not compared
+        if not categories:
+            continue
+        changes = snapshots.update(key, categories)
+        if not changes:
+            continue
+        changed = True
+        if json_output:
+            # one line per changed plan
+            canteen, date, language = key
+            record = {"canteen": canteen, "date": date, "language": language}
+            record.update(changes.to_dict())
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            file.write(format_changes(key, changes, colors=colors))
+        canteen, date, _ = key
+        if archive is not None:
+            archive.store(canteen, date, language, categories)
+        if xml_output:
+            save_xml(categories, canteen, date)
+    file.flush()
+    return changed
+
+
+def query_archive(
+    archive: "MealArchive",
+    canteen: Optional[str],
+    language: str,
+    last_served: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    filter_mode: Optional[str] = None,
+    gluten_free: bool = False,
+    price: str = "Student",
+    limit: int = 1,
+    colors: bool = True,
+) -> None:
+    QUERY_COLOR = Fore.MAGENTA if colors else ""
+    MEAL_COLOR = Fore.BLUE if colors else ""
+    PRICE_COLOR = Fore.CYAN if colors else ""
+    WARN_COLOR = Fore.RED if colors else ""
+    RESET_COLOR = Style.RESET_ALL if colors else ""
+
+    if last_served:
+        results = archive.last_served(
+            last_served,
+            canteen=canteen,
+            language=language,
+            until=until or datetime.date.today().isoformat(),
+            limit=limit,
+        )
     else:
-        raise NotImplementedError(filter_mode)
+        results = archive.cheapest(
+            since=since or datetime.date.today().replace(day=1).isoformat(),
+            until=until,
+            canteen=canteen,
+            language=language,
+            exclude_allergens=get_remove_allergens(filter_mode, gluten_free, language),
+            price=price,
+            limit=limit,
+        )
 
-    if gluten_free:
-        remove_allergens.update(gluten_allergens[language])
+    if not results:
+        print(f"{WARN_COLOR}No matching meal found in the archive.{RESET_COLOR}")
+        return
 
-    maxlen_catname = max(len(cat.title) for cat in queried_categories)
-    if markdown_output:
-        print(f"| {output_strs['MD_TABLE_COL_CAT'][language]}", end="")
-        print(f"| {output_strs['MD_TABLE_COL_MEAL'][language]}", end="")
-        print(f"| {output_strs['MD_TABLE_COL_PRICE'][language]}", end="")
-        if show_all_allergens:
-            print(f"| {output_strs['MD_TABLE_COL_ALLERGENS'][language]}", end="")
-        else:
-            print(f"| {output_strs['MD_TABLE_COL_SOME_ALLERGENS'][language]}", end="")
-        if show_additives:
-            print(f"| {output_strs['MD_TABLE_COL_ADDITIVES'][language]}", end="")
-        if show_co2:
-            print(f"| {output_strs['MD_TABLE_COL_CO2'][language]}", end="")
-        print(" |")
-        print(f"| :-- | :-- | --: | :-- | ", end="")
-        if show_additives:
-            print(":-- |", end="")
-        if show_co2:
-            print(":-- |", end="")
-        print()
-
-    for cat in queried_categories:
-        filtered_meals = [
-            meal for meal in cat.meals if not set(meal.allergens) & remove_allergens
-        ]
-
-        if not filtered_meals:
-            continue
+    price_attr = PRICE_ATTRS[price]
+    for date, meal_canteen, category, meal in results:
+        meal_price = getattr(meal, price_attr)
+        price_str = f" {PRICE_COLOR}({meal_price/100:.2f}€)" if meal_price else ""
+        print(
+            f"{QUERY_COLOR}{date} {meal_canteen} – {category}: "
+            f"{MEAL_COLOR}{meal.title}{price_str}{RESET_COLOR}"
+        )
 
-        if markdown_output:
-            for meal_idx, meal in enumerate(filtered_meals):
-                if meal_idx:
-                    print(f"| |", end="")
-                else:
-                    print(f"| {cat.title} |", end="")
-                if price == "Student":
-                    print(f" {meal.title} | {meal.student_price/100:.2f}€ |", end="")
-                if price == "Staff":
-                    print(f" {meal.title} | {meal.staff_price/100:.2f}€ |", end="")
-                if price == "Guest":
-                    print(f" {meal.title} | {meal.guest_price/100:.2f}€ |", end="")
-
-                if show_all_allergens:
-                    allergen_str = ", ".join(meal.allergens)
-                else:
-                    allergen_str = ", ".join(
-                        al for al in meal.allergens if al in interesting_allergens
-                    )
-                print(f" {allergen_str} |", end="")
 
-                if show_additives:
-                    additives_str = ", ".join(meal.additives)
-                    print(f" {additives_str} |", end="")
+def positive_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
 
-                if show_co2:
-                    co2_str = f"{meal.co2_emission}g" if meal.co2_emission else ""
-                    print(f" {co2_str} |", end="")
 
-                print("")
-        else:
-            cat_str = cat.title.ljust(maxlen_catname + 1)
-            print(f"{CATEGORY_COLOR}{cat_str}{RESET_COLOR}", end="")
-
-            for meal_idx, meal in enumerate(filtered_meals):
-                # do not indent first line
-                if meal_idx:
-                    print(" " * (maxlen_catname + 1), end="")
-                if price == "Student":
-                    print(
-                        f"{MEAL_COLOR}{meal.title} {PRICE_COLOR}({meal.student_price/100:.2f}€)",
-                        end="",
-                    )
-                if price == "Staff":
-                    print(
-                        f"{MEAL_COLOR}{meal.title} {PRICE_COLOR}({meal.staff_price/100:.2f}€)",
-                        end="",
-                    )
-                if price == "Guest":
-                    print(
-                        f"{MEAL_COLOR}{meal.title} {PRICE_COLOR}({meal.guest_price/100:.2f}€)",
-                        end="",
-                    )
-                if meal.allergens and (
-                    show_all_allergens or set(meal.allergens) & interesting_allergens
-                ):
-                    if show_all_allergens:
-                        allergen_str = ", ".join(meal.allergens)
-                    else:
-                        allergen_str = ", ".join(
-                            al for al in meal.allergens if al in interesting_allergens
-                        )
-                    print(f" {ALLERGEN_COLOR}[{allergen_str}]", end="")
+def non_negative_int(value: str) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a non-negative integer")
+    return number
 
-                if show_additives and meal.additives:
-                    additives_str = ", ".join(meal.additives)
-                    print(f" {ADDITIVE_COLOR}[{additives_str}]", end="")
 
-                if show_co2 and meal.co2_tag and meal.co2_emission:
-                    color = CO2_COLORS[meal.co2_tag]
-                    print(f" {color}[{meal.co2_emission}g CO₂e]", end="")
+def iso_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid date {value!r}, expected YYYY-MM-DD"
+        ) from None
 
-                print(f"{RESET_COLOR}")
 
-    if xml_output:
-        xml_root = parser.to_xml(canteen)
-        xml_tree = ET.ElementTree(xml_root)
-        filename = f"{canteen}_{date}_{time.time()}.xml"
-        xml_tree.write(filename, encoding="utf-8", xml_declaration=True, method="xml")
-        print(f"XML saved to {filename}")
-    if pdf:
+def filter_rule(value: str) -> str:
+    from bonn_mensa.filters import FilterError, parse_rule
 
-        parser.to_pdf(canteen)
+    try:
+        parse_rule(value)
+    except FilterError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+    return value
 
 
 def get_parser():
@@ -655,10 +2094,10 @@ def get_parser():
     )
     parser.add_argument(
         "--mensa",
-        choices=canteen_id_dict.keys(),
+        choices=[*canteen_id_dict.keys(), "all"],
         type=str,
         default="CAMPO",
-        help="The canteen to query. Defaults to CAMPO.",
+        help="The canteen to query, or 'all' to query every canteen. Defaults to CAMPO.",
     )
     parser.add_argument(
         "--filter-categories",
@@ -667,12 +2106,40 @@ def get_parser():
         default=["Buffet", "Dessert"],
         help="Meal categories to hide. Defaults to ['Buffet', 'Dessert'].",
     )
+    parser.add_argument(
+        "--filter",
+        type=filter_rule,
+        action="append",
+        default=[],
+        metavar="RULE",
+        help="""Only show meals matching RULE, can be given multiple times. Rules are
+            allergen=CODES, allergen!=CODES, additive=CODES, additive!=CODES, category!=NAMES,
+            co2=green,orange, title~REGEX, title!~REGEX and price<=EUR (or student, staff and
+            guest<=EUR). Allergens and additives are given by code or by name in German or English, separated by commas.""",
+    )
     parser.add_argument(
         "--date",
-        type=str,
+        type=iso_date,
         default=None,
         help="The date to query for in YYYY -MM-DD format. Defaults to today.",
     )
+    parser.add_argument(
+        "--days",
+        type=positive_int,
+        default=1,
+        help="The number of open days to query, starting at --date. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--week",
+        action="store_true",
+        help="Query all open days of the week of --date, or of the upcoming week on weekends.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=4,
+        help="The maximum number of concurrent requests when querying several canteens or days. Defaults to 4.",
+    )
     parser.add_argument(
         "--price",
         type=str,
@@ -688,6 +2155,11 @@ def get_parser():
         help="The language of the meal plan to query. Defaults to German.",
     )
 
+    parser.add_argument(
+        "--bilingual",
+        action="store_true",
+        help="Also show the titles in the other language. The other plan is only fetched for its titles.",
+    )
     parser.add_argument(
         "--show-all-allergens",
         action="store_true",
@@ -712,17 +2184,40 @@ def get_parser():
         help="Do not use any ANSI colors in the output.",
     )
 
-    parser.add_argument(
+    output_group = parser.add_mutually_exclusive_group()
+    output_group.add_argument(
         "--markdown",
         action="store_true",
         help="Output in markdown table format.",
     )
+    output_group.add_argument(
+        "--json",
+        action="store_true",
+        help="Output the plans as one JSON array. Prices are in cents.",
+    )
+    output_group.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Output one JSON object per meal and line, as soon as its plan arrives.",
+    )
 
     parser.add_argument(
         "--verbose",
         action="store_true",
         help="Print debug output.",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time spent per stage and plan to stderr when done.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        metavar="FILE",
+        help="""Write the time spent per stage to FILE, as JSON if it ends in .json,
+            otherwise in the Prometheus text format.""",
+    )
 
     parser.add_argument(
         "--version",
@@ -746,11 +2241,161 @@ def get_parser():
         action="store_true",
         help="Save the current weeks pdf plan in current Directory",
     )
+    parser.add_argument(
+        "--openmensa",
+        type=str,
+        metavar="DIR",
+        help="""Write an OpenMensa feed per canteen into DIR, covering all queried days.
+            Can be combined with --mensa all, --days and --week.""",
+    )
+    parser.add_argument(
+        "--save-snapshot",
+        type=str,
+        metavar="FILE",
+        help="Save the parsed plans to FILE, compressed if it ends in .gz, to show them later with --from-snapshot.",
+    )
+    parser.add_argument(
+        "--from-snapshot",
+        type=str,
+        metavar="FILE",
+        help="""Show the plans saved in FILE by --save-snapshot in the language of --lang,
+            instead of querying the API.""",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not read or write the local response cache.",
+    )
+    parser.add_argument(
+        "--changes",
+        action="store_true",
+        help="""Only print meals that were added, removed or changed since the plan was last
+            queried with --changes. Exits with status 1 if a plan changed, 0 otherwise.""",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore cached responses and query the API again.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=DEFAULT_TTL,
+        help=f"Seconds a cached plan of today or a future day is used without asking the API again. Defaults to {DEFAULT_TTL}.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for the API to respond. Defaults to 30.",
+    )
+    parser.add_argument(
+        "--max-wait",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="""Show the last good copy of a plan from the cache or the --archive, marked as
+            stale, if the API has not answered after SECONDS. Plans that failed are always
+            replaced by their last good copy.""",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f"How often failed requests are retried. Defaults to {DEFAULT_RETRIES}.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        metavar="RATE",
+        help="""The maximum number of requests per second to the API, after a burst of up to
+            RATE requests. Defaults to no limit.""",
+    )
+    parser.add_argument(
+        "--rate-limit-file",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="""Share the --rate-limit with all processes using the same FILE, e.g. several
+            services on one machine. Only works on Unix.""",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        help="Store every queried plan in the local archive.",
+    )
+    parser.add_argument(
+        "--archive-path",
+        type=str,
+        default=None,
+        help="The SQLite database of the archive. Defaults to $XDG_DATA_HOME/bonn-mensa/archive.sqlite3.",
+    )
+    parser.add_argument(
+        "--last-served",
+        type=str,
+        metavar="MEAL",
+        default=None,
+        help="Look up in the archive when a meal containing MEAL was served last.",
+    )
+    parser.add_argument(
+        "--cheapest",
+        action="store_true",
+        help="Look up the cheapest meal in the archive, respecting --vegan, --vegetarian, --glutenfree and --price.",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        default=None,
+        help="First day considered by --cheapest in YYYY-MM-DD format. Defaults to the first day of the current month.",
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        default=None,
+        help="Last day considered by --cheapest and --last-served in YYYY-MM-DD format.",
+    )
+    parser.add_argument(
+        "--limit",
+        type=positive_int,
+        default=1,
+        help="The number of archive results to show. Defaults to 1.",
+    )
 
     return parser
 
 
 def run_cmd(args):
+    timings = None
+    if args.profile or args.metrics:
+        timings = Timings()
+        set_timings(timings)
+    start = time.perf_counter()
+
+    try:
+        if args.json or args.ndjson:
+            import contextlib
+
+            # only the plans are written to stdout, so it can be parsed as is,
+            # everything else goes to stderr
+            stdout = sys.stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                return run_query(args, file=stdout)
+        return run_query(args)
+    finally:
+        if timings is not None:
+            set_timings(None)
+            if args.profile:
+                # the stages of concurrent plans overlap, so their sum may
+                # exceed the wall time
+                sys.stderr.write(timings.format_table())
+                wall_ms = 1000 * (time.perf_counter() - start)
+                sys.stderr.write(f"wall time {wall_ms:.1f}ms\n")
+            if args.metrics:
+                timings.save(args.metrics)
+
+
+def run_query(args, file: Optional[TextIO] = None):
     if args.vegan:
         filter_mode: Optional[str] = "vegan"
     elif args.vegetarian:
@@ -758,9 +2403,56 @@ def run_cmd(args):
     else:
         filter_mode = None
 
-    query_mensa(
-        date=args.date,
-        canteen=args.mensa,
+    if args.last_served or args.cheapest:
+        from bonn_mensa.archive import MealArchive
+
+        query_archive(
+            MealArchive(args.archive_path),
+            canteen=None if args.mensa == "all" else args.mensa,
+            language=args.lang,
+            last_served=args.last_served,
+            since=args.since,
+            until=args.until,
+            filter_mode=filter_mode,
+            gluten_free=args.glutenfree,
+            price=args.price,
+            limit=args.limit,
+            colors=not args.no_colors,
+        )
+        return
+
+    filtered = bool(args.filter or filter_mode or args.glutenfree)
+    if args.changes and filtered:
+        # the changes are those of the whole plan
+        get_parser().error(
+            "--changes can not be combined with --vegan, --vegetarian, --glutenfree or --filter"
+        )
+
+    # the renderers build their filter from the diet flags, but e.g. the
+    # --openmensa feeds are only filtered by meal_filter
+    meal_filter = None
+    if filtered:
+        from bonn_mensa.filters import FilterError, MealFilter
+
+        try:
+            meal_filter = MealFilter.from_rules(
+                args.filter or (),
+                language=args.lang,
+                filter_mode=filter_mode,
+                gluten_free=args.glutenfree,
+                exclude_categories=args.filter_categories,
+                price=args.price,
+            )
+        except FilterError as e:
+            get_parser().error(str(e))
+
+    title_languages = (
+        [lang for lang in language_id_dict if lang != args.lang]
+        if args.bilingual
+        else []
+    )
+
+    renderer_args = dict(
         language=args.lang,
         filtered_categories=args.filter_categories,
         filter_mode=filter_mode,
@@ -770,19 +2462,167 @@ def run_cmd(args):
         gluten_free=args.glutenfree,
         colors=not args.no_colors,
         markdown_output=args.markdown,
-        verbose=args.verbose,
+        json_output=args.json,
+        ndjson_output=args.ndjson,
         price=args.price,
+        meal_filter=meal_filter,
+    )
+
+    if args.from_snapshot:
+        from bonn_mensa.snapshot import SnapshotError, load_snapshot
+
+        try:
+            snapshot_plans = load_snapshot(args.from_snapshot, language=args.lang)
+        except SnapshotError as e:
+            print(e, file=sys.stderr)
+            return 1
+        query_mensas(
+            dates=[],
+            canteens=[],
+            xml_output=args.xml,
+            snapshot=args.save_snapshot,
+            snapshot_plans=snapshot_plans,
+            file=file,
+            **renderer_args,
+        )
+        return
+
+    archive = None
+    if args.archive:
+        from bonn_mensa.archive import MealArchive
+
+        archive = MealArchive(args.archive_path)
+
+    cache = None if args.no_cache else ResponseCache(ttl=args.cache_ttl)
+    rate_limits = {}
+    if args.rate_limit > 0:
+        from urllib.parse import urlsplit
+
+        if args.rate_limit_file:
+            limiter = FileRateLimiter(
+                args.rate_limit_file, args.rate_limit, burst=args.rate_limit
+            )
+        else:
+            limiter = RateLimiter(args.rate_limit, burst=args.rate_limit)
+        rate_limits[urlsplit(MEALS_URL).hostname] = limiter
+    set_client(
+        HttpClient(
+            timeout=(min(5.0, args.timeout), args.timeout),
+            retries=args.retries,
+            pool_size=max(args.jobs, DEFAULT_POOL_SIZE),
+            rate_limits=rate_limits,
+        )
+    )
+
+    if (
+        args.changes
+        or args.openmensa
+        or args.mensa == "all"
+        or args.days > 1
+        or args.week
+    ):
+        canteens = list(canteen_id_dict.keys()) if args.mensa == "all" else [args.mensa]
+        if args.week:
+            day = datetime.date.today() if args.date is None else args.date
+            open_days = get_open_days_of_week(day)
+        else:
+            if args.date is None:
+                start = get_mensa_data()
+            else:
+                start = args.date
+            open_days = get_open_days(start, args.days)
+        dates = [day.strftime("%Y-%m-%d") for day in open_days]
+        if args.changes:
+            changed = query_changes(
+                dates=dates,
+                canteens=canteens,
+                language=args.lang,
+                verbose=args.verbose,
+                colors=not args.no_colors,
+                xml_output=args.xml,
+                max_workers=args.jobs,
+                cache=cache,
+                refresh=args.refresh,
+                archive=archive,
+                json_output=args.json or args.ndjson,
+                file=file,
+            )
+            return 1 if changed else 0
+        if args.openmensa:
+            from bonn_mensa.openmensa import write_feeds
+
+            plans = iter_meal_plans(
+                canteens=canteens,
+                dates=dates,
+                languages=[args.lang],
+                max_workers=args.jobs,
+                verbose=args.verbose,
+                cache=cache,
+                refresh=args.refresh,
+            )
+            for filename in write_feeds(plans, args.openmensa, meal_filter):
+                print(f"Saved {filename}")
+            return
+        query_mensas(
+            dates=dates,
+            canteens=canteens,
+            verbose=args.verbose,
+            xml_output=args.xml,
+            pdf=args.pdf,
+            max_workers=args.jobs,
+            max_wait=args.max_wait,
+            cache=cache,
+            refresh=args.refresh,
+            archive=archive,
+            title_languages=title_languages,
+            snapshot=args.save_snapshot,
+            file=file,
+            **renderer_args,
+        )
+        return
+
+    query_mensa(
+        date=None if args.date is None else args.date.isoformat(),
+        canteen=args.mensa,
+        verbose=args.verbose,
         xml_output=args.xml,
         pdf=args.pdf,
+        max_workers=args.jobs,
+        max_wait=args.max_wait,
+        cache=cache,
+        refresh=args.refresh,
+        archive=archive,
+        title_languages=title_languages,
+        snapshot=args.save_snapshot,
+        file=file,
+        **renderer_args,
     )
 
 
+# commands that are not about showing a meal plan live in their own modules,
+# each providing get_parser and run_cmd
+subcommands = {
+    "serve": "bonn_mensa.server",
+    "prefetch": "bonn_mensa.prefetch",
+    "backfill": "bonn_mensa.backfill",
+}
+
+
 def main():
+    import argcomplete
+
     colorama_init()
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        module = importlib.import_module(subcommands[sys.argv[1]])
+        parser = module.get_parser()
+        argcomplete.autocomplete(parser)
+        args = parser.parse_args(sys.argv[2:])
+        sys.exit(module.run_cmd(args))
+
     parser = get_parser()
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
-    run_cmd(args)
+    sys.exit(run_cmd(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import os
+from typing import TYPE_CHECKING, BinaryIO, Dict, Iterable, List, Optional, Tuple
+from xml.sax.saxutils import XMLGenerator
+
+from bonn_mensa.mensa import (
+    OPENMENSA_NAMESPACES,
+    OPENMENSA_PARSER_VERSION,
+    OPENMENSA_PRICE_ROLES,
+    OPENMENSA_SCHEMA_LOCATION,
+    PRICE_ATTRS,
+    Category,
+    PlanKey,
+)
+from bonn_mensa.timing import measure
+
+if TYPE_CHECKING:
+    from bonn_mensa.filters import MealFilter
+
+
+class OpenMensaFeedWriter:
+    # writes an OpenMensa v2 feed of one canteen day by day, so a feed over
+    # many days never has to be held in memory as a whole
+    def __init__(self, file: BinaryIO, canteen: str) -> None:
+        self.canteen = canteen
+        self._xml = XMLGenerator(file, encoding="utf-8", short_empty_elements=True)
+
+    def _element(self, name: str, text: str, attrs: Optional[Dict] = None) -> None:
+        self._xml.startElement(name, attrs or {})
+        self._xml.characters(text)
+        self._xml.endElement(name)
+
+    def start(self) -> None:
+        self._xml.startDocument()
+        self._xml.startElement(
+            "openmensa",
+            {
+                "version": "2.1",
+                "xmlns": OPENMENSA_NAMESPACES[""],
+                "xmlns:xsi": OPENMENSA_NAMESPACES["xsi"],
+                "xsi:schemaLocation": OPENMENSA_SCHEMA_LOCATION,
+            },
+        )
+        self._element("version", OPENMENSA_PARSER_VERSION)
+        self._xml.startElement("canteen", {})
+        self._element("name", f"Mensa {self.canteen}")
+
+    def write_day(self, date: str, categories: List[Category]) -> None:
+        self._xml.startElement("day", {"date": date})
+        for cat in categories:
+            self._xml.startElement("category", {"name": cat.title})
+            for meal in cat.meals:
+                self._xml.startElement("meal", {})
+                self._element("name", meal.title)
+                for note in meal.allergens + meal.additives:
+                    self._element("note", note)
+                for price_name, role in OPENMENSA_PRICE_ROLES.items():
+                    price = getattr(meal, PRICE_ATTRS[price_name])
+                    if price is not None:
+                        self._element("price", f"{price / 100:.2f}", {"role": role})
+                self._xml.endElement("meal")
+            self._xml.endElement("category")
+        self._xml.endElement("day")
+
+    def end(self) -> None:
+        self._xml.endElement("canteen")
+        self._xml.endElement("openmensa")
+        self._xml.endDocument()
+
+    def __enter__(self) -> "OpenMensaFeedWriter":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.end()
+
+
+def feed_filename(directory: str, canteen: str) -> str:
+    return os.path.join(directory, f"{canteen.replace('/', '-')}.xml")
+
+
+def write_feeds(
+    plans: Iterable[Tuple[PlanKey, List[Category]]],
+    directory: str,
+    meal_filter: Optional["MealFilter"] = None,
+) -> List[str]:
+    # plans may arrive in any order and for any canteen, every canteen gets
+    # its own feed file, which is written as soon as a plan arrives
+    os.makedirs(directory, exist_ok=True)
+    files: Dict[str, BinaryIO] = {}
+    writers: Dict[str, OpenMensaFeedWriter] = {}
+    try:
+        for key, categories in plans:
+            canteen, date, _ = key
+            if meal_filter is not None:
+                with measure(key, "filter"):
+                    categories = meal_filter.filter_plan(categories)
+            # an empty plan may just not be published yet, so the day is left
+            # out instead of marking the canteen as closed
+            if not categories:
+                continue
+            writer = writers.get(canteen)
+            if writer is None:
+                files[canteen] = open(feed_filename(directory, canteen), "wb")
+                writer = writers[canteen] = OpenMensaFeedWriter(files[canteen], canteen)
+                writer.start()
+            with measure(key, "export"):
+                writer.write_day(date, categories)
+        for writer in writers.values():
+            writer.end()
+    finally:
+        for file in files.values():
+            file.close()
+
+    return [feed_filename(directory, canteen) for canteen in writers]
@@ -0,0 +1,146 @@
+import datetime
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bonn_mensa.cache import default_cache_dir
+from bonn_mensa.client import HttpClient, get_client
+from bonn_mensa.mensa import canteen_id_dict_pdf
+
+PDF_URL = (
+    "http://www.maxmanager.de/daten-extern/sw-bonn/pdf/wochenplaene/{id}/aktuell_de.pdf"
+)
+PDF_CHUNK_SIZE = 64 * 1024
+
+# (canteen, filename or None, message)
+PdfResult = Tuple[str, Optional[str], str]
+
+
+def pdf_filename(canteen: str, directory: str = "") -> str:
+    # Get Calenderweek for the plan
+    cw = datetime.date.today().isocalendar()[1]
+    return os.path.join(directory, f"{canteen.replace('/', '-')}_KW_{cw}_weekplan.pdf")
+
+
+class PdfFetcher:
+    # remembers the validators and the hash of the last download of every
+    # canteen, so an unchanged plan is neither downloaded nor written again
+    def __init__(
+        self,
+        directory: str = "",
+        state_dir: Optional[str] = None,
+        client: Optional[HttpClient] = None,
+    ) -> None:
+        self.directory = directory
+        self.state_dir = state_dir or os.path.join(default_cache_dir(), "pdf")
+        self.client = client
+
+    def _state_path(self, canteen: str) -> str:
+        return os.path.join(self.state_dir, f"{canteen_id_dict_pdf[canteen]}.json")
+
+    def load_state(self, canteen: str) -> Dict:
+        try:
+            with open(self._state_path(canteen), encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, canteen: str, state: Dict) -> None:
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self._state_path(canteen), "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file)
+
+    def fetch(self, canteen: str) -> PdfResult:
+        import tempfile
+
+        import requests
+
+        client = self.client or get_client()
+        filename = pdf_filename(canteen, self.directory)
+        state = self.load_state(canteen)
+
+        # validators only help if the file they describe is still there
+        headers = {}
+        if state.get("filename") == filename and os.path.exists(filename):
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        url = PDF_URL.format(id=canteen_id_dict_pdf[canteen])
+        try:
+            response = client.get(url, headers=headers, stream=True)
+        except requests.exceptions.RetryError as e:
+            # the server answered with an error status until the retries ran out
+            return canteen, None, f"Failed to download PDF: {e}"
+        with response:
+            if response.status_code == 304:
+                return canteen, filename, f"PDF {filename} is up to date"
+            if response.status_code != 200:
+                return (
+                    canteen,
+                    None,
+                    f"Failed to download PDF. HTTP Status Code: {response.status_code}",
+                )
+
+            # the body is hashed while it is written, it is never held in
+            # memory as a whole
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+            digest = hashlib.sha256()
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory or ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    for chunk in response.iter_content(chunk_size=PDF_CHUNK_SIZE):
+                        digest.update(chunk)
+                        tmp_file.write(chunk)
+                sha256 = digest.hexdigest()
+                unchanged = (
+                    state.get("sha256") == sha256
+                    and state.get("filename") == filename
+                    and os.path.exists(filename)
+                )
+                if unchanged:
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, filename)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            self.save_state(
+                canteen,
+                {
+                    "filename": filename,
+                    "sha256": sha256,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                },
+            )
+
+        if unchanged:
+            return canteen, filename, f"PDF {filename} is up to date"
+        return canteen, filename, f"PDF saved to {filename}"
+
+    def fetch_all(
+        self, canteens: Iterable[str], max_workers: int = 4
+    ) -> List[PdfResult]:
+        from concurrent.futures import ThreadPoolExecutor
+
+        # canteens without a weekly pdf plan are skipped
+        canteens = [canteen for canteen in canteens if canteen in canteen_id_dict_pdf]
+        if len(canteens) <= 1:
+            return [self.fetch(canteen) for canteen in canteens]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.fetch, canteens))
+
+
+def save_pdfs(
+    canteens: Iterable[str],
+    max_workers: int = 4,
+    client: Optional[HttpClient] = None,
+) -> None:
+    for _, _, message in PdfFetcher(client=client).fetch_all(canteens, max_workers):
+        print(message)
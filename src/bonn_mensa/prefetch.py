@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import random
+import time
+from typing import List, Optional, Sequence
+
+from bonn_mensa.cache import ResponseCache
+from bonn_mensa.client import DEFAULT_POOL_SIZE, HttpClient, get_client, set_client
+from bonn_mensa.mensa import (
+    MEALS_URL,
+    PlanKey,
+    canteen_id_dict,
+    fetch_meal_plan,
+    get_open_days,
+    language_id_dict,
+    meal_plan_fields,
+    positive_int,
+)
+
+DEFAULT_DAYS = 2
+DEFAULT_JITTER = 5.0
+
+
+def parse_times(value: str) -> List[datetime.time]:
+    times = set()
+    for part in value.split(","):
+        try:
+            times.add(datetime.time.fromisoformat(part.strip()))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"Invalid time {part.strip()!r}, expected HH:MM"
+            ) from None
+    return sorted(times)
+
+
+def next_run(
+    times: Sequence[datetime.time], after: Optional[datetime.datetime] = None
+) -> datetime.datetime:
+    after = after or datetime.datetime.now()
+    today = after.date()
+    for day in (today, today + datetime.timedelta(days=1)):
+        for at in times:
+            run = datetime.datetime.combine(day, at)
+            if run > after:
+                return run
+    raise ValueError("No prefetch times given")
+
+
+def prefetch_keys(
+    days: int, languages: Sequence[str], today: Optional[datetime.date] = None
+) -> List[PlanKey]:
+    # the plans of the next open days of every canteen, which are the ones
+    # asked for around lunch
+    open_days = get_open_days(today or datetime.date.today(), days)
+    return [
+        (canteen, day.isoformat(), language)
+        for day in open_days
+        for canteen in canteen_id_dict
+        for language in languages
+    ]
+
+
+def prefetch(
+    keys: Sequence[PlanKey],
+    cache: ResponseCache,
+    fresh_until: Optional[float] = None,
+    max_workers: int = 4,
+    jitter: float = DEFAULT_JITTER,
+    url: str = MEALS_URL,
+    client: Optional[HttpClient] = None,
+    verbose: bool = False,
+) -> List[PlanKey]:
+    # fetches and parses the plans into the cache and returns the keys of the
+    # plans that were published
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = client or get_client()
+
+    def fetch(key: PlanKey) -> bool:
+        canteen, date, language = key
+        # spreads the requests, so the upstream does not see a burst at every
+        # scheduled time
+        time.sleep(random.uniform(0, jitter))
+        try:
+            categories = fetch_meal_plan(
+                date=date,
+                canteen=canteen,
+                language=language,
+                url=url,
+                verbose=verbose,
+                cache=cache,
+                refresh=True,
+                client=client,
+            )
+        except Exception as e:
+            print(f"Prefetching {canteen} for {date} [{language}] failed: {e}")
+            return False
+        # a plan that is not published yet is asked for again by the next
+        # query instead of being kept empty
+        if not categories:
+            return False
+        if fresh_until is not None:
+            cache.keep_fresh(meal_plan_fields(date, canteen, language), fresh_until)
+        if verbose:
+            print(f"Prefetched {canteen} for {date} [{language}]")
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        published = list(executor.map(fetch, keys))
+    return [key for key, ok in zip(keys, published) if ok]
+
+
+def run_prefetch(args, cache: ResponseCache, fresh_until: Optional[float]) -> None:
+    keys = prefetch_keys(args.days, args.lang)
+    start = time.perf_counter()
+    fetched = prefetch(
+        keys,
+        cache,
+        fresh_until=fresh_until,
+        max_workers=args.jobs,
+        jitter=args.jitter,
+        verbose=args.verbose,
+    )
+    seconds = time.perf_counter() - start
+    print(f"Prefetched {len(fetched)} of {len(keys)} plans in {seconds:.1f}s")
+
+
+def sleep_until(run: datetime.datetime) -> None:
+    # sleeps in short steps, so a suspended machine does not oversleep
+    while True:
+        remaining = (run - datetime.datetime.now()).total_seconds()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 60))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("mensa prefetch")
+    parser.add_argument(
+        "--at",
+        type=parse_times,
+        default=None,
+        metavar="HH:MM,...",
+        help="Keep running and prefetch at these times every day. Without it, the plans are prefetched once.",
+    )
+    parser.add_argument(
+        "--days",
+        type=positive_int,
+        default=DEFAULT_DAYS,
+        help=f"The number of open days to prefetch, starting today. Defaults to {DEFAULT_DAYS}.",
+    )
+    parser.add_argument(
+        "--lang",
+        nargs="+",
+        choices=list(language_id_dict),
+        default=list(language_id_dict),
+        help="The languages to prefetch. Defaults to all.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=4,
+        help="The maximum number of concurrent requests. Defaults to 4.",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=DEFAULT_JITTER,
+        metavar="SECONDS",
+        help=f"Delay every request by a random time of up to SECONDS. Defaults to {DEFAULT_JITTER:g}.",
+    )
+    parser.add_argument(
+        "--fresh-for",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="""How long queries use the prefetched plans without asking the API. Defaults to
+            the next scheduled prefetch with --at, otherwise to the --cache-ttl of the query.""",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for the API to respond. Defaults to 30.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print every prefetched plan.",
+    )
+    return parser
+
+
+def run_cmd(args):
+    cache = ResponseCache()
+    set_client(
+        HttpClient(
+            timeout=(min(5.0, args.timeout), args.timeout),
+            pool_size=max(args.jobs, DEFAULT_POOL_SIZE),
+        )
+    )
+
+    if not args.at:
+        fresh_until = None if args.fresh_for is None else time.time() + args.fresh_for
+        run_prefetch(args, cache, fresh_until)
+        return
+
+    try:
+        while True:
+            run = next_run(args.at)
+            print(f"Next prefetch at {run:%Y-%m-%d %H:%M}")
+            sleep_until(run)
+            # the plans are used until the next run replaces them
+            if args.fresh_for is None:
+                fresh_until = next_run(args.at, run).timestamp()
+            else:
+                fresh_until = time.time() + args.fresh_for
+            run_prefetch(args, cache, fresh_until)
+    except KeyboardInterrupt:
+        pass
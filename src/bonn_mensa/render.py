@@ -0,0 +1,434 @@
+import json
+import math
+import sys
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, TextIO, Union
+
+from colorama import Fore, Style
+
+from bonn_mensa.filters import MealFilter
+from bonn_mensa.mensa import (
+    PRICE_ATTRS,
+    Category,
+    Meal,
+    allergen_vocabulary,
+    info_code,
+    meal_to_dict,
+    meat_allergens,
+    other_allergens,
+    output_strs,
+    ovo_lacto_allergens,
+)
+from bonn_mensa.timing import get_timings
+
+
+def display_title(item: Union[Category, Meal]) -> str:
+    # bilingual plans show the titles in all languages
+    if not item.translations:
+        return item.title
+    titles = [item.title]
+    titles.extend(title for title in item.translations.values() if title not in titles)
+    return " / ".join(titles)
+
+
+def format_age(seconds: float) -> str:
+    if math.isinf(seconds):
+        return "an unknown time"
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} min"
+    if minutes < 24 * 60:
+        return f"{minutes // 60} h {minutes % 60} min"
+    return f"{minutes // (24 * 60)} days"
+
+
+def stale_fields(stale_age: Optional[float]) -> Dict:
+    # the age of a stale plan in seconds, None if it is not known
+    if stale_age is None:
+        return {"stale": False}
+    age = None if math.isinf(stale_age) else round(stale_age)
+    return {"stale": True, "stale_age": age}
+
+
+class Renderer:
+    # collects the output in a buffer, which is written to the file at once
+    # by flush, instead of issuing one write per printed field
+
+    # written after every plan that was rendered as part of a report
+    plan_separator = "\n"
+    # whether plans should be written as soon as they arrive
+    streaming = False
+
+    def __init__(
+        self,
+        language: str,
+        filtered_categories: Iterable[str] = (),
+        filter_mode: Optional[str] = None,
+        show_all_allergens: bool = False,
+        show_additives: bool = False,
+        show_co2: bool = False,
+        gluten_free: bool = False,
+        price: str = "Student",
+        colors: bool = False,
+        meal_filter: Optional[MealFilter] = None,
+    ) -> None:
+        self.language = language
+        self.filter_mode = filter_mode
+        self.show_all_allergens = show_all_allergens
+        self.show_additives = show_additives
+        self.show_co2 = show_co2
+        self.price_attr = PRICE_ATTRS[price]
+
+        self.interesting_allergens = (
+            meat_allergens[language]
+            | ovo_lacto_allergens[language]
+            | other_allergens[language]
+        )
+        self.interesting_mask = allergen_vocabulary.mask(
+            info_code(allergen) for allergen in self.interesting_allergens
+        )
+        if meal_filter is None:
+            meal_filter = MealFilter.from_rules(
+                (),
+                language=language,
+                filter_mode=filter_mode,
+                gluten_free=gluten_free,
+                exclude_categories=filtered_categories,
+            )
+        self.meal_filter = meal_filter
+
+        if colors:
+            self.QUERY_COLOR = Fore.MAGENTA
+            self.CATEGORY_COLOR = Fore.GREEN
+            self.MEAL_COLOR = Fore.BLUE
+            self.PRICE_COLOR = Fore.CYAN
+            self.ALLERGEN_COLOR = Fore.RED
+            self.ADDITIVE_COLOR = Fore.YELLOW
+            self.WARN_COLOR = Fore.RED
+            self.RESET_COLOR = Style.RESET_ALL
+            self.CO2_COLORS = {
+                "CO2_TAG_GREEN": Fore.LIGHTGREEN_EX,
+                "CO2_TAG_ORANGE": Fore.LIGHTYELLOW_EX,
+                "CO2_TAG_RED": Fore.LIGHTRED_EX,
+            }
+        else:
+            self.QUERY_COLOR = ""
+            self.CATEGORY_COLOR = ""
+            self.MEAL_COLOR = ""
+            self.PRICE_COLOR = ""
+            self.ALLERGEN_COLOR = ""
+            self.ADDITIVE_COLOR = ""
+            self.WARN_COLOR = ""
+            self.RESET_COLOR = ""
+            self.CO2_COLORS = {
+                "CO2_TAG_GREEN": "",
+                "CO2_TAG_ORANGE": "",
+                "CO2_TAG_RED": "",
+            }
+
+        self._buffer: List[str] = []
+        self.write = self._buffer.append
+        # seconds spent in filter_meals, reported apart from rendering
+        self.filter_seconds = 0.0
+
+    def getvalue(self) -> str:
+        return "".join(self._buffer)
+
+    def flush(self, file: Optional[TextIO] = None) -> None:
+        file = file or sys.stdout
+        file.write(self.getvalue())
+        file.flush()
+        self._buffer.clear()
+
+    def format_price(self, meal: Meal) -> str:
+        price = getattr(meal, self.price_attr)
+        return "" if price is None else f"{price/100:.2f}€"
+
+    def allergen_str(self, meal: Meal) -> str:
+        if self.show_all_allergens:
+            return ", ".join(meal.allergens)
+        return ", ".join(
+            al for al in meal.allergens if al in self.interesting_allergens
+        )
+
+    def filter_meals(self, cat: Category) -> List[Meal]:
+        start = time.perf_counter()
+        meals = self.meal_filter.filter_meals(cat.meals)
+        self.filter_seconds += time.perf_counter() - start
+        return meals
+
+    def render(
+        self,
+        categories: List[Category],
+        date: str,
+        canteen: str,
+        stale_age: Optional[float] = None,
+        info: Sequence[str] = (),
+    ) -> bool:
+        filter_str = f" [{self.filter_mode}]" if self.filter_mode else ""
+        self.render_header(f"Mensa {canteen} – {date}{filter_str} [{self.language}]")
+        # e.g. why the canteen is closed
+        for line in info:
+            self.write(f"{line}\n")
+        if stale_age is not None:
+            self.write(
+                f"{self.WARN_COLOR}The plan could not be fetched, the copy shown was fetched {format_age(stale_age)} ago and may be outdated.{self.RESET_COLOR}\n"
+            )
+
+        if not categories:
+            self.write(
+                f"{self.WARN_COLOR}Query failed. Please check https://www.studierendenwerk-bonn.de if the mensa is open today.{self.RESET_COLOR}\n"
+            )
+            return False
+        self.write("\n")
+
+        queried_categories = [
+            cat for cat in categories if not self.meal_filter.hides_category(cat.title)
+        ]
+        if queried_categories:
+            self.render_categories(queried_categories)
+        return True
+
+    def render_header(self, title: str) -> None:
+        raise NotImplementedError
+
+    def render_categories(self, categories: List[Category]) -> None:
+        raise NotImplementedError
+
+
+class TerminalRenderer(Renderer):
+    def __init__(self, language: str, colors: bool = True, **kwargs) -> None:
+        super().__init__(language, colors=colors, **kwargs)
+
+    def render_header(self, title: str) -> None:
+        self.write(f"{self.QUERY_COLOR}{title}{self.RESET_COLOR}\n")
+
+    def render_categories(self, categories: List[Category]) -> None:
+        write = self.write
+        maxlen_catname = max(len(display_title(cat)) for cat in categories)
+        indent = " " * (maxlen_catname + 1)
+
+        for cat in categories:
+            filtered_meals = self.filter_meals(cat)
+            if not filtered_meals:
+                continue
+
+            cat_str = display_title(cat).ljust(maxlen_catname + 1)
+            write(f"{self.CATEGORY_COLOR}{cat_str}{self.RESET_COLOR}")
+
+            for meal_idx, meal in enumerate(filtered_meals):
+                # do not indent first line
+                if meal_idx:
+                    write(indent)
+                write(
+                    f"{self.MEAL_COLOR}{display_title(meal)} {self.PRICE_COLOR}({self.format_price(meal)})"
+                )
+                if meal.allergens and (
+                    self.show_all_allergens
+                    or meal.allergen_mask & self.interesting_mask
+                ):
+                    write(f" {self.ALLERGEN_COLOR}[{self.allergen_str(meal)}]")
+
+                if self.show_additives and meal.additives:
+                    additives_str = ", ".join(meal.additives)
+                    write(f" {self.ADDITIVE_COLOR}[{additives_str}]")
+
+                if self.show_co2 and meal.co2_tag and meal.co2_emission:
+                    color = self.CO2_COLORS[meal.co2_tag]
+                    write(f" {color}[{meal.co2_emission}g CO₂e]")
+
+                write(f"{self.RESET_COLOR}\n")
+
+
+class PlainRenderer(TerminalRenderer):
+    def __init__(self, language: str, **kwargs) -> None:
+        kwargs["colors"] = False
+        super().__init__(language, **kwargs)
+
+
+class MarkdownRenderer(Renderer):
+    def __init__(self, language: str, **kwargs) -> None:
+        super().__init__(language, **kwargs)
+
+        # the table head only depends on the options
+        columns = [
+            output_strs["MD_TABLE_COL_CAT"][language],
+            output_strs["MD_TABLE_COL_MEAL"][language],
+            output_strs["MD_TABLE_COL_PRICE"][language],
+            (
+                output_strs["MD_TABLE_COL_ALLERGENS"][language]
+                if self.show_all_allergens
+                else output_strs["MD_TABLE_COL_SOME_ALLERGENS"][language]
+            ),
+        ]
+        alignment = "| :-- | :-- | --: | :-- | "
+        if self.show_additives:
+            columns.append(output_strs["MD_TABLE_COL_ADDITIVES"][language])
+            alignment += ":-- |"
+        if self.show_co2:
+            columns.append(output_strs["MD_TABLE_COL_CO2"][language])
+            alignment += ":-- |"
+        self.table_head = "".join(f"| {col}" for col in columns) + " |\n"
+        self.table_head += alignment + "\n"
+
+    def render_header(self, title: str) -> None:
+        self.write(f"### {title}\n\n")
+
+    def render_categories(self, categories: List[Category]) -> None:
+        write = self.write
+        write(self.table_head)
+
+        for cat in categories:
+            for meal_idx, meal in enumerate(self.filter_meals(cat)):
+                if meal_idx:
+                    write("| |")
+                else:
+                    write(f"| {display_title(cat)} |")
+                write(f" {display_title(meal)} | {self.format_price(meal)} |")
+                write(f" {self.allergen_str(meal)} |")
+
+                if self.show_additives:
+                    additives_str = ", ".join(meal.additives)
+                    write(f" {additives_str} |")
+
+                if self.show_co2:
+                    co2_str = f"{meal.co2_emission}g" if meal.co2_emission else ""
+                    write(f" {co2_str} |")
+
+                write("\n")
+
+
+def meal_record(meal: Meal) -> Dict:
+    record = meal_to_dict(meal)
+    record["allergen_codes"] = meal.allergen_codes
+    record["additive_codes"] = meal.additive_codes
+    return record
+
+
+class JsonRenderer(Renderer):
+    # all plans of a report form one JSON array, failed queries are included
+    # with no categories
+    plan_separator = ""
+
+    def __init__(self, language: str, **kwargs) -> None:
+        kwargs["colors"] = False
+        super().__init__(language, **kwargs)
+        self.plans: List[Dict] = []
+
+    def plan_categories(self, categories: List[Category]) -> List[Dict]:
+        plan = []
+        for cat in categories:
+            if self.meal_filter.hides_category(cat.title):
+                continue
+            meals = self.filter_meals(cat)
+            if not meals:
+                continue
+            cat_dict: Dict = {"title": cat.title}
+            if cat.translations:
+                cat_dict["translations"] = dict(cat.translations)
+            cat_dict["meals"] = [meal_record(meal) for meal in meals]
+            plan.append(cat_dict)
+        return plan
+
+    def render(
+        self,
+        categories: List[Category],
+        date: str,
+        canteen: str,
+        stale_age: Optional[float] = None,
+        info: Sequence[str] = (),
+    ) -> bool:
+        plan = {
+            "canteen": canteen,
+            "date": date,
+            "language": self.language,
+            **stale_fields(stale_age),
+            "categories": self.plan_categories(categories),
+        }
+        if info:
+            plan["info"] = list(info)
+        self.plans.append(plan)
+        return bool(categories)
+
+    def getvalue(self) -> str:
+        return json.dumps(self.plans, ensure_ascii=False, indent=2) + "\n"
+
+    def flush(self, file: Optional[TextIO] = None) -> None:
+        super().flush(file)
+        self.plans.clear()
+
+
+class NdjsonRenderer(Renderer):
+    # one line per meal, so consumers can process them as they arrive
+    plan_separator = ""
+    streaming = True
+
+    def __init__(self, language: str, **kwargs) -> None:
+        kwargs["colors"] = False
+        super().__init__(language, **kwargs)
+
+    def render(
+        self,
+        categories: List[Category],
+        date: str,
+        canteen: str,
+        stale_age: Optional[float] = None,
+        info: Sequence[str] = (),
+    ) -> bool:
+        # one line per meal, so the info text of a plan without meals is lost
+        plan = {"canteen": canteen, "date": date, "language": self.language}
+        plan.update(stale_fields(stale_age))
+        for cat in categories:
+            if self.meal_filter.hides_category(cat.title):
+                continue
+            for meal in self.filter_meals(cat):
+                record = {**plan, "category": cat.title, **meal_record(meal)}
+                self.write(json.dumps(record, ensure_ascii=False))
+                self.write("\n")
+        return bool(categories)
+
+
+def render_plan(
+    renderer: Renderer,
+    categories: List[Category],
+    date: str,
+    canteen: str,
+    stale_age: Optional[float] = None,
+    info: Sequence[str] = (),
+) -> bool:
+    # renders a plan and records the time spent filtering and rendering it
+    timings = get_timings()
+    if timings is None:
+        return renderer.render(
+            categories, date=date, canteen=canteen, stale_age=stale_age, info=info
+        )
+    filter_seconds = renderer.filter_seconds
+    start = time.perf_counter()
+    success = renderer.render(
+        categories, date=date, canteen=canteen, stale_age=stale_age, info=info
+    )
+    seconds = time.perf_counter() - start
+    filter_seconds = renderer.filter_seconds - filter_seconds
+    key = (canteen, date, renderer.language)
+    timings.add(key, "filter", filter_seconds)
+    timings.add(key, "render", seconds - filter_seconds)
+    return success
+
+
+def get_renderer(
+    language: str,
+    markdown_output: bool = False,
+    colors: bool = True,
+    json_output: bool = False,
+    ndjson_output: bool = False,
+    **kwargs,
+) -> Renderer:
+    if ndjson_output:
+        return NdjsonRenderer(language, **kwargs)
+    if json_output:
+        return JsonRenderer(language, **kwargs)
+    if markdown_output:
+        return MarkdownRenderer(language, colors=colors, **kwargs)
+    if colors:
+        return TerminalRenderer(language, **kwargs)
+    return PlainRenderer(language, **kwargs)
@@ -0,0 +1,354 @@
+import argparse
+import collections
+import datetime
+import json
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import xml.etree.ElementTree as ET
+
+import bonn_mensa.version
+from bonn_mensa.cache import DEFAULT_PAST_TTL, DEFAULT_TTL
+from bonn_mensa.filters import FilterError, MealFilter
+from bonn_mensa.mensa import (
+    MEALS_URL,
+    Category,
+    PlanKey,
+    canteen_id_dict,
+    category_to_dict,
+    fetch_meal_plan,
+    get_open_days,
+    language_id_dict,
+    meal_plan_to_xml,
+)
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_REFRESH_INTERVAL = 10 * 60
+# empty plans of today or later days are asked for again sooner, they may
+# just not be published yet
+DEFAULT_EMPTY_TTL = 5 * 60
+
+
+class PlanCache:
+    # in-memory LRU cache of parsed plans; concurrent requests for a plan that
+    # is not cached yet wait for a single upstream fetch. Expired plans are
+    # served stale while they are refreshed in the background.
+    def __init__(
+        self,
+        fetch: Callable[[str, str, str], List[Category]],
+        max_entries: int = DEFAULT_CACHE_SIZE,
+        ttl: float = DEFAULT_TTL,
+        past_ttl: float = DEFAULT_PAST_TTL,
+        empty_ttl: float = DEFAULT_EMPTY_TTL,
+    ) -> None:
+        self._fetch = fetch
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.past_ttl = past_ttl
+        self.empty_ttl = empty_ttl
+        # key -> (fetch time, categories), least recently used first
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+        self._in_flight: Dict[PlanKey, Future] = {}
+        self._lock = threading.Lock()
+
+    def ttl_for(self, date: str) -> float:
+        if datetime.date.fromisoformat(date) < datetime.date.today():
+            return self.past_ttl
+        return self.ttl
+
+    def ttl_of(self, date: str, categories: List[Category]) -> float:
+        # the plans of past days do not change, even if they are empty
+        if categories or datetime.date.fromisoformat(date) < datetime.date.today():
+            return self.ttl_for(date)
+        return min(self.ttl, self.empty_ttl)
+
+    def keys(self) -> List[PlanKey]:
+        with self._lock:
+            return list(self._entries)
+
+    def get(self, key: PlanKey, refresh: bool = False) -> List[Category]:
+        return self.lookup(key, refresh=refresh)[0]
+
+    def lookup(
+        self, key: PlanKey, refresh: bool = False
+    ) -> Tuple[List[Category], float]:
+        # the plan and the seconds since it was fetched. Only plans that were
+        # never fetched, or are refreshed explicitly, wait for the upstream.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and not refresh:
+                self._entries.move_to_end(key)
+                age = time.monotonic() - entry[0]
+                if age >= self.ttl_of(key[1], entry[1]) and key not in self._in_flight:
+                    future: Future = Future()
+                    self._in_flight[key] = future
+                    threading.Thread(
+                        target=self._revalidate, args=(key, future), daemon=True
+                    ).start()
+                return entry[1], age
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if owner:
+            self._update(key, future)
+        return future.result(), 0.0
+
+    def _update(self, key: PlanKey, future: Future) -> None:
+        canteen, date, language = key
+        try:
+            categories = self._fetch(canteen, date, language)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            # an empty plan does not replace a stale one, which is better than
+            # none, but is kept otherwise, so closed days are not fetched again
+            # on every request
+            entry = self._entries.get(key)
+            if categories or entry is None or not entry[1]:
+                self._entries[key] = (time.monotonic(), categories)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            del self._in_flight[key]
+        future.set_result(categories)
+
+    def _revalidate(self, key: PlanKey, future: Future) -> None:
+        # the stale plan stays in the cache if the upstream is down
+        try:
+            self._update(key, future)
+        except Exception as e:
+            print(f"Refreshing {key} failed: {e}")
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class MensaRequestHandler(BaseHTTPRequestHandler):
+    server_version = f"bonn-mensa/{bonn_mensa.version.__version__}"
+    plan_cache: PlanCache
+    verbose: bool = False
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        routes = {
+            "/canteens": self.get_canteens,
+            "/plan": self.get_plan,
+            "/openmensa": self.get_openmensa,
+        }
+        route = routes.get(url.path.rstrip("/") or "/")
+        try:
+            if route is None:
+                raise RequestError(404, f"Unknown path {url.path}")
+            route(query)
+        except RequestError as e:
+            self.send_json({"error": e.message}, status=e.status)
+        except Exception as e:
+            self.send_json({"error": f"Upstream query failed: {e}"}, status=502)
+
+    def log_message(self, format: str, *args) -> None:
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, content, status: int = 200) -> None:
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        self.send_body(body, "application/json; charset=utf-8", status=status)
+
+    def parse_plan_key(self, query: Dict[str, str]) -> PlanKey:
+        canteen = query.get("canteen", "CAMPO")
+        if canteen not in canteen_id_dict:
+            raise RequestError(400, f"Unknown canteen {canteen}")
+
+        language = query.get("lang", "de")
+        if language not in language_id_dict:
+            raise RequestError(400, f"Unknown language {language}")
+
+        if "date" in query:
+            try:
+                date = datetime.date.fromisoformat(query["date"])
+            except ValueError:
+                raise RequestError(400, f"Invalid date {query['date']}") from None
+        else:
+            date = get_open_days(datetime.date.today(), 1)[0]
+
+        return canteen, date.isoformat(), language
+
+    def get_canteens(self, query: Dict[str, str]) -> None:
+        self.send_json(
+            [{"name": name, "id": id} for name, id in canteen_id_dict.items()]
+        )
+
+    def get_plan(self, query: Dict[str, str]) -> None:
+        canteen, date, language = key = self.parse_plan_key(query)
+
+        filters = [f for f in query.get("filter", "").split(",") if f]
+        unknown = set(filters) - {"vegan", "vegetarian", "glutenfree"}
+        if unknown:
+            raise RequestError(400, f"Unknown filter {', '.join(sorted(unknown))}")
+        if "vegan" in filters:
+            filter_mode: Optional[str] = "vegan"
+        elif "vegetarian" in filters:
+            filter_mode = "vegetarian"
+        else:
+            filter_mode = None
+        rules = [rule for rule in query.get("rules", "").split(";") if rule.strip()]
+        try:
+            meal_filter = MealFilter.from_rules(
+                rules,
+                language=language,
+                filter_mode=filter_mode,
+                gluten_free="glutenfree" in filters,
+            )
+        except FilterError as e:
+            raise RequestError(400, str(e)) from None
+
+        categories, age = self.plan_cache.lookup(key)
+        plan = [category_to_dict(cat) for cat in meal_filter.filter_plan(categories)]
+
+        self.send_json(
+            {
+                "canteen": canteen,
+                "date": date,
+                "language": language,
+                # seconds since the plan was fetched from the upstream
+                "age": round(age),
+                "stale": age >= self.plan_cache.ttl_of(date, categories),
+                "categories": plan,
+            }
+        )
+
+    def get_openmensa(self, query: Dict[str, str]) -> None:
+        key = self.parse_plan_key(query)
+        root = meal_plan_to_xml(self.plan_cache.get(key), key[0], date=key[1])
+        body = ET.tostring(root, encoding="utf-8", xml_declaration=True)
+        self.send_body(body, "application/xml; charset=utf-8")
+
+
+def refresh_today(
+    plan_cache: PlanCache, interval: float, stop: threading.Event
+) -> None:
+    # keeps the plans of today that were asked for up to date, so clients
+    # never wait for the upstream during the day
+    while not stop.wait(interval):
+        today = datetime.date.today().isoformat()
+        for key in plan_cache.keys():
+            if key[1] != today:
+                continue
+            try:
+                plan_cache.get(key, refresh=True)
+            except Exception as e:
+                print(f"Refreshing {key} failed: {e}")
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    url: str = MEALS_URL,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    ttl: float = DEFAULT_TTL,
+    refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+    verbose: bool = False,
+) -> None:
+    plan_cache = PlanCache(
+        lambda canteen, date, language: fetch_meal_plan(
+            date=date, canteen=canteen, language=language, url=url
+        ),
+        max_entries=cache_size,
+        ttl=ttl,
+    )
+    handler = type(
+        "Handler",
+        (MensaRequestHandler,),
+        {"plan_cache": plan_cache, "verbose": verbose},
+    )
+    httpd = ThreadingHTTPServer((host, port), handler)
+
+    stop = threading.Event()
+    if refresh_interval > 0:
+        threading.Thread(
+            target=refresh_today,
+            args=(plan_cache, refresh_interval, stop),
+            daemon=True,
+        ).start()
+
+    print(f"Serving meal plans on http://{host}:{port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser("mensa serve")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address to listen on. Defaults to 127.0.0.1.",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="The port to listen on. Defaults to 8080.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help=f"The number of parsed plans kept in memory. Defaults to {DEFAULT_CACHE_SIZE}.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=DEFAULT_TTL,
+        help=f"Seconds a plan of today or a future day is served from memory. Defaults to {DEFAULT_TTL}.",
+    )
+    parser.add_argument(
+        "--refresh-interval",
+        type=int,
+        default=DEFAULT_REFRESH_INTERVAL,
+        help=f"Seconds between background refreshes of today's plans, 0 disables them. Defaults to {DEFAULT_REFRESH_INTERVAL}.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log every request.",
+    )
+    return parser
+
+
+def run_cmd(args):
+    serve(
+        host=args.host,
+        port=args.port,
+        cache_size=args.cache_size,
+        ttl=args.cache_ttl,
+        refresh_interval=args.refresh_interval,
+        verbose=args.verbose,
+    )
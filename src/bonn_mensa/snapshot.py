@@ -0,0 +1,149 @@
+import json
+import sys
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from bonn_mensa.mensa import (
+    Category,
+    Meal,
+    PlanKey,
+    Vocabulary,
+    additive_vocabulary,
+    allergen_vocabulary,
+)
+
+SNAPSHOT_FORMAT = "bonn-mensa-plans"
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def plan_to_snapshot(categories: List[Category], info: Sequence[str] = ()) -> Dict:
+    # a parsed plan as plain JSON types. Allergens and additives are stored
+    # once per plan and referred to by index, meals are lists instead of
+    # objects, which keeps snapshots small and quick to load.
+    allergens: Dict[str, int] = {}
+    additives: Dict[str, int] = {}
+    snapshot_categories = []
+    for cat in categories:
+        meals = []
+        for meal in cat.meals:
+            record = [
+                meal.title,
+                [allergens.setdefault(a, len(allergens)) for a in meal.allergens],
+                [additives.setdefault(a, len(additives)) for a in meal.additives],
+                meal.student_price,
+                meal.staff_price,
+                meal.guest_price,
+                meal.co2_emission,
+                meal.co2_tag,
+            ]
+            if meal.translations:
+                record.append(meal.translations)
+            meals.append(record)
+        entry: list = [cat.title, meals]
+        if cat.translations:
+            entry.append(cat.translations)
+        snapshot_categories.append(entry)
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "allergens": list(allergens),
+        "additives": list(additives),
+        "categories": snapshot_categories,
+    }
+    # the info text of closed canteens
+    if info:
+        snapshot["info"] = list(info)
+    return snapshot
+
+
+def _terms(words: List[str], vocabulary: Vocabulary) -> List[Tuple[str, int]]:
+    return [(sys.intern(word), vocabulary.info_bit(word)) for word in words]
+
+
+def plan_from_snapshot(snapshot: Dict) -> List[Category]:
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {snapshot.get('version')}")
+    try:
+        # the bits are looked up once per plan instead of once per meal
+        allergens = _terms(snapshot["allergens"], allergen_vocabulary)
+        additives = _terms(snapshot["additives"], additive_vocabulary)
+        categories = []
+        for title, meals, *cat_translations in snapshot["categories"]:
+            cat = Category(title)
+            if cat_translations:
+                cat.translations = cat_translations[0]
+            for record in meals:
+                meal = Meal(record[0])
+                for index in record[1]:
+                    allergen, bit = allergens[index]
+                    meal.allergens.append(allergen)
+                    meal.allergen_mask |= bit
+                for index in record[2]:
+                    additive, bit = additives[index]
+                    meal.additives.append(additive)
+                    meal.additive_mask |= bit
+                (
+                    meal.student_price,
+                    meal.staff_price,
+                    meal.guest_price,
+                    meal.co2_emission,
+                    meal.co2_tag,
+                ) = record[3:8]
+                if len(record) > 8:
+                    meal.translations = record[8]
+                cat.meals.append(meal)
+            categories.append(cat)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise SnapshotError(f"Invalid snapshot: {e!r}") from None
+    return categories
+
+
+def save_snapshot(
+    filename: str, plans: Iterable[Tuple[PlanKey, List[Category]]]
+) -> None:
+    # several plans in one file, compressed if the name ends in .gz
+    content = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "plans": [
+            {
+                "canteen": canteen,
+                "date": date,
+                "language": language,
+                **plan_to_snapshot(categories),
+            }
+            for (canteen, date, language), categories in plans
+        ],
+    }
+    import gzip
+
+    encoded = json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "wt", encoding="utf-8") as snapshot_file:
+        snapshot_file.write(encoded)
+
+
+def load_snapshot(
+    filename: str, language: Optional[str] = None
+) -> Dict[PlanKey, List[Category]]:
+    import gzip
+
+    opener = gzip.open if filename.endswith(".gz") else open
+    try:
+        with opener(filename, "rt", encoding="utf-8") as snapshot_file:
+            content = json.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Could not read snapshot {filename}: {e}") from None
+    if not isinstance(content, dict) or content.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"{filename} is not a meal plan snapshot")
+
+    plans = {}
+    for plan in content.get("plans", []):
+        if language is not None and plan.get("language") != language:
+            continue
+        key = (plan.get("canteen"), plan.get("date"), plan.get("language"))
+        plans[key] = plan_from_snapshot(plan)
+    return plans
@@ -0,0 +1,151 @@
+import contextlib
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
+
+# (canteen, date, language), like PlanKey
+TimingKey = Tuple[str, str, str]
+
+# in the order they happen for a plan
+STAGES = ["cache", "request", "download", "parse", "filter", "render", "export"]
+
+
+class Timings:
+    # collects the seconds spent per stage for every plan, e.g. waiting for the
+    # upstream or parsing. Stages of a plan that happen several times, like
+    # parsing the chunks of a response, are summed up.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.plans: Dict[TimingKey, Dict[str, float]] = {}
+
+    def add(self, key: TimingKey, stage: str, seconds: float) -> None:
+        with self._lock:
+            stages = self.plans.setdefault(key, {})
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def stages(self) -> List[str]:
+        seen = {stage for stages in self.plans.values() for stage in stages}
+        return [stage for stage in STAGES if stage in seen] + sorted(seen - set(STAGES))
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary: Dict[str, Dict[str, float]] = {}
+        for stage in self.stages():
+            times = [stages[stage] for stages in self.plans.values() if stage in stages]
+            summary[stage] = {
+                "count": len(times),
+                "total": sum(times),
+                "max": max(times),
+            }
+        return summary
+
+    def to_dict(self) -> Dict:
+        return {
+            "plans": [
+                {
+                    "canteen": canteen,
+                    "date": date,
+                    "language": language,
+                    "stages": dict(stages),
+                }
+                for (canteen, date, language), stages in sorted(self.plans.items())
+            ],
+            "stages": self.summary(),
+        }
+
+    def format_table(self) -> str:
+        # one row per plan and one column per stage, in milliseconds
+        stages = self.stages()
+        header = ["plan", *stages, "total"]
+        rows = []
+        for (canteen, date, language), plan_stages in sorted(self.plans.items()):
+            times = [plan_stages.get(stage) for stage in stages]
+            rows.append(
+                [f"{canteen} {date} {language}"]
+                + ["" if time is None else f"{1000 * time:.1f}" for time in times]
+                + [f"{1000 * sum(t for t in times if t):.1f}"]
+            )
+        summary = self.summary()
+        rows.append(
+            ["total"]
+            + [f"{1000 * summary[stage]['total']:.1f}" for stage in stages]
+            + [f"{1000 * sum(s['total'] for s in summary.values()):.1f}"]
+        )
+
+        widths = [
+            max(len(row[i]) for row in [header, *rows]) for i in range(len(header))
+        ]
+        lines = []
+        for row in [header, *rows]:
+            cells = [row[0].ljust(widths[0])]
+            cells.extend(cell.rjust(width) for cell, width in zip(row[1:], widths[1:]))
+            lines.append("  ".join(cells))
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file: TextIO) -> None:
+        # in the text format of the Prometheus node exporter, aggregated per
+        # canteen and stage to keep the number of series small
+        per_canteen: Dict[Tuple[str, str], List[float]] = {}
+        for (canteen, _, _), stages in self.plans.items():
+            for stage, seconds in stages.items():
+                per_canteen.setdefault((canteen, stage), []).append(seconds)
+
+        file.write(
+            "# HELP mensa_stage_seconds Seconds spent per stage of a meal plan.\n"
+        )
+        file.write("# TYPE mensa_stage_seconds summary\n")
+        for (canteen, stage), times in sorted(per_canteen.items()):
+            labels = f'canteen="{canteen}",stage="{stage}"'
+            file.write(f"mensa_stage_seconds_sum{{{labels}}} {sum(times)}\n")
+            file.write(f"mensa_stage_seconds_count{{{labels}}} {len(times)}\n")
+        file.write(
+            "# HELP mensa_stage_seconds_max Longest time of a stage of a plan.\n"
+        )
+        file.write("# TYPE mensa_stage_seconds_max gauge\n")
+        for (canteen, stage), times in sorted(per_canteen.items()):
+            labels = f'canteen="{canteen}",stage="{stage}"'
+            file.write(f"mensa_stage_seconds_max{{{labels}}} {max(times)}\n")
+
+    def save(self, filename: str) -> None:
+        # Prometheus text files are picked up while they are written, so the
+        # metrics are written to a temporary file first
+        import json
+        import os
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            if filename.endswith(".json"):
+                json.dump(self.to_dict(), tmp_file, indent=2)
+                tmp_file.write("\n")
+            else:
+                self.write_prometheus(tmp_file)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filename)
+
+
+_timings: Optional[Timings] = None
+
+
+def get_timings() -> Optional[Timings]:
+    # None unless timings are collected, so callers can skip the bookkeeping
+    return _timings
+
+
+def set_timings(timings: Optional[Timings]) -> None:
+    global _timings
+    _timings = timings
+
+
+@contextlib.contextmanager
+def measure(key: TimingKey, stage: str) -> Iterator[None]:
+    timings = _timings
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(key, stage, time.perf_counter() - start)